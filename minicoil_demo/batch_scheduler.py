@@ -0,0 +1,218 @@
+"""
+Micro-batching of concurrent requests of the service.
+
+Requests are queued in the event loop and a single scheduler task collects them into batches:
+a batch is closed once it has `max_batch_size` items, or `max_wait` seconds after its first item arrived.
+Each batch is encoded with one call in the inference thread, so the event loop is never blocked.
+While a batch is running, new requests pile up in the queue and form the next batch without any extra wait.
+If a batch fails, its items are retried one by one, so a single bad request fails only its own caller.
+
+Inference runs in a single thread: a batch is already parallelized by ONNX Runtime internally,
+and caches of the model are not thread-safe.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+
+class MicroBatchScheduler:
+
+    def __init__(
+            self,
+            encode_batch: Callable[[List[Any]], List[Any]],
+            max_batch_size: int = 32,
+            max_wait: float = 0.002,
+            max_queue_size: int = 4096
+    ):
+        """
+        Args:
+            encode_batch: called in the inference thread with a list of items, must return a result per item
+            max_batch_size: maximum number of items in a batch
+            max_wait: seconds to wait for more items after the first item of a batch
+            max_queue_size: requests beyond this wait for a free slot before they are queued
+        """
+        self.encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.item_queued: Optional[asyncio.Event] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.task: Optional[asyncio.Task] = None
+
+        self.batches = 0
+        self.items = 0
+        self.failed_batches = 0
+        self.inference_time = 0.0
+
+    def start(self):
+        """
+        Must be called from the running event loop, e.g. on application startup
+        """
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.item_queued = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="minicoil-inference")
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+        # Requests still in the queue would wait forever
+        while self.queue is not None and not self.queue.empty():
+            _item, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Scheduler is stopped"))
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def submit(self, item: Any) -> Any:
+        if self.task is None:
+            raise RuntimeError("Scheduler is not started")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        self.item_queued.set()
+        return await future
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """
+        Run `fn` in the inference thread, in between batches, e.g. to encode a large request on its own
+        """
+        if self.task is None:
+            raise RuntimeError("Scheduler is not started")
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        batch = [await self.queue.get()]
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            # Waiting on the queue itself with a timeout might lose an item, if it arrives right at the timeout
+            self.item_queued.clear()
+            try:
+                await asyncio.wait_for(self.item_queued.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+        # Clients might have disconnected while waiting
+        return [(item, future) for item, future in batch if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.encode_batch, items)
+            except Exception as e:
+                if len(batch) == 1:
+                    _, future = batch[0]
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    await self._run_one_by_one(batch)
+                continue
+            finally:
+                self.inference_time += time.perf_counter() - start
+
+            self.batches += 1
+            self.items += len(items)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_one_by_one(self, batch: List[Tuple[Any, asyncio.Future]]):
+        """
+        Retry items of a failed batch separately, each caller gets its own result or exception
+        """
+        loop = asyncio.get_running_loop()
+        self.failed_batches += 1
+        for item, future in batch:
+            if future.done():
+                continue
+            try:
+                [result] = await loop.run_in_executor(self.executor, self.encode_batch, [item])
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += 1
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait": self.max_wait,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches > 0 else 0.0,
+            "failed_batches": self.failed_batches,
+            "inference_time": self.inference_time,
+        }
+
+
+def test_micro_batch_scheduler():
+    batches = []
+
+    def encode_batch(items: List[int]) -> List[int]:
+        batches.append(list(items))
+        time.sleep(0.01)
+        if -1 in items:
+            raise ValueError("bad item")
+        return [item * 2 for item in items]
+
+    async def run():
+        scheduler = MicroBatchScheduler(encode_batch, max_batch_size=4, max_wait=0.005)
+        scheduler.start()
+
+        results = await asyncio.gather(*(scheduler.submit(i) for i in range(10)))
+        assert results == [i * 2 for i in range(10)]
+        assert all(len(batch) <= 4 for batch in batches)
+        assert len(batches) < 10
+
+        try:
+            await scheduler.submit(-1)
+            assert False, "exception is expected"
+        except ValueError:
+            pass
+
+        # One bad item among concurrent ones fails only its own caller
+        batches.clear()
+        results = await asyncio.gather(*(scheduler.submit(i) for i in [1, -1, 2, 3]), return_exceptions=True)
+        assert results[0] == 2 and results[2:] == [4, 6]
+        assert isinstance(results[1], ValueError)
+        assert len(batches[0]) > 1
+        assert scheduler.stats()["failed_batches"] == 1
+
+        assert await scheduler.submit(5) == 10
+        assert await scheduler.run(encode_batch, [1, 2]) == [2, 4]
+        await scheduler.stop()
+
+    asyncio.run(run())
@@ -40,6 +40,7 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-name", type=str)
+    parser.add_argument("--word-encoder-path", type=str, default=None) # Overrides weights of the model, e.g. converted to float16 or int8
     parser.add_argument("--input-path-queries", type=str)
     parser.add_argument("--input-path-qrels", type=str)
     parser.add_argument("--collection-name", type=str, default="minicoil-demo")
@@ -70,7 +71,7 @@ def main():
         return result.points
 
     vocab_path = os.path.join(DATA_DIR, f"{model_name}.vocab")
-    model_path = os.path.join(DATA_DIR, f"{model_name}.npy")
+    model_path = args.word_encoder_path or os.path.join(DATA_DIR, f"{model_name}.npy")
     transformer_model = "jinaai/jina-embeddings-v2-small-en-tokens"
 
     model = MiniCOIL(
@@ -0,0 +1,59 @@
+"""
+Grouping of tokenized documents into batches of similar length, so that little transformer compute is spent on padding.
+"""
+from typing import List
+
+import numpy as np
+
+
+def length_buckets(lengths: np.ndarray, max_tokens: int, max_batch_size: int = 64) -> List[np.ndarray]:
+    """
+    Split documents into batches of documents with similar lengths.
+
+    Documents are sorted by length and grouped greedily, while the padded size of the batch,
+    `batch_size * longest_document`, stays within `max_tokens`.
+    A document longer than `max_tokens` forms a batch of its own.
+
+    Args:
+        lengths: (num_documents) - number of tokens in each document, including special tokens
+        max_tokens: limit of tokens in a padded batch
+        max_batch_size: limit of documents in a batch
+
+    Returns:
+        List of arrays with indices of documents in each batch, shortest documents first
+    """
+    order = np.argsort(lengths, kind="stable")
+    sorted_lengths = lengths[order].tolist()
+
+    buckets = []
+    start = 0
+    for end, length in enumerate(sorted_lengths):
+        batch_size = end - start + 1
+        # Sorted ascending, so the current document is the longest one in the batch
+        if end > start and (batch_size * length > max_tokens or batch_size > max_batch_size):
+            buckets.append(order[start:end])
+            start = end
+
+    if start < len(sorted_lengths):
+        buckets.append(order[start:])
+
+    return buckets
+
+
+def padded_size(lengths: np.ndarray, buckets: List[np.ndarray]) -> int:
+    """
+    Number of tokens, including padding, processed by the transformer for the given batches
+    """
+    return sum(len(bucket) * int(lengths[bucket].max()) for bucket in buckets)
+
+
+def test_length_buckets():
+    lengths = np.array([10, 500, 12, 11, 300, 10, 2000])
+
+    buckets = length_buckets(lengths, max_tokens=1000, max_batch_size=3)
+
+    assert [bucket.tolist() for bucket in buckets] == [[0, 5, 3], [2, 4], [1], [6]]
+    assert sorted(np.concatenate(buckets).tolist()) == list(range(len(lengths)))
+    assert padded_size(lengths, buckets) == 3 * 11 + 2 * 300 + 500 + 2000
+
+    assert length_buckets(np.array([], dtype=np.int64), max_tokens=1000) == []
@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """
+    Bounded mapping, which evicts least recently used entries and counts hits and misses.
+    If `ttl` is set, entries also expire `ttl` seconds after they are put.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if self.ttl is not None:
+            # Entries are stored along with their expiration time
+            expires_at, value = value
+            if expires_at < time.monotonic():
+                del self.data[key]
+                self.expired += 1
+                self.misses += 1
+                return default
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.ttl is not None:
+            value = (time.monotonic() + self.ttl, value)
+
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_rate": self.hit_rate,
+        }
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # "b" is the least recently used one
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+    cache.ttl = -1
+    cache.put("d", 4)
+    assert cache.get("d") is None
+    assert cache.stats()["expired"] == 1
@@ -0,0 +1,366 @@
+"""
+Compiled miniCOIL vocabulary: a read-only, memory-mapped replacement of the JSON `.vocab` file.
+
+The file is mapped as is, no Python dicts are built on load, and pages are shared between all processes
+using the same file. Words are looked up in an open-addressing hash table stored in the file, full hashes are stored along with slots,
+so a lookup of a missing word almost never compares strings.
+
+Layout, all numbers are little-endian, every section is aligned to 8 bytes:
+
+    magic: 8 bytes, `COMPILED_VOCAB_MAGIC`
+    header: 9 uint64 - number of elements in each section below
+    word_offsets: (num_words + 1) int64 - word `i` occupies [word_offsets[i], word_offsets[i + 1]) of `word_bytes`,
+        words are in the order of vocab ids, i.e. word `i` has vocab id `i + 1`
+    word_bytes: uint8 - utf-8 encoded words, concatenated
+    word_slots: (2^k) int32 - hash table with linear probing: index of the word or -1 for an empty slot
+    word_hashes: (2^k) uint32 - murmur3 hash of the word in each slot
+    stem_offsets: (num_stems + 1) int64
+    stem_bytes: uint8
+    stem_slots: (2^k) int32
+    stem_hashes: (2^k) uint32
+    stem_word_ids: (num_stems) int32 - vocab id of the word each stem maps to
+
+Resolving every token of the tokenizer vocabulary, see `VocabResolver.build_token_tables`, takes a lookup per token,
+so resolved tokens are saved next to the compiled vocab as `<vocab>.<tokenizer hash>.tokens.npy`
+the first time and memory-mapped afterwards.
+"""
+import hashlib
+import mmap
+import os
+from typing import Iterator, List, Optional, Tuple
+
+import mmh3
+import numpy as np
+
+COMPILED_VOCAB_MAGIC = b"MCVOCAB1"
+
+# Name, dtype and memoryview format of sections, in the order of the file
+SECTIONS = (
+    ("word_offsets", "<i8", "q"),
+    ("word_bytes", "u1", "B"),
+    ("word_slots", "<i4", "i"),
+    ("word_hashes", "<u4", "I"),
+    ("stem_offsets", "<i8", "q"),
+    ("stem_bytes", "u1", "B"),
+    ("stem_slots", "<i4", "i"),
+    ("stem_hashes", "<u4", "I"),
+    ("stem_word_ids", "<i4", "i"),
+)
+
+HEADER_SIZE = len(COMPILED_VOCAB_MAGIC) + 8 * len(SECTIONS)
+
+
+def _aligned(size: int) -> int:
+    return (size + 7) // 8 * 8
+
+
+def _encode_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Offsets, bytes, hash table slots and hashes of the strings
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    # Load factor is at most 0.5, so probe sequences stay short
+    num_slots = 1
+    while num_slots < 2 * len(encoded):
+        num_slots *= 2
+    mask = num_slots - 1
+
+    slots = np.full(num_slots, -1, dtype=np.int32)
+    hashes = np.zeros(num_slots, dtype=np.uint32)
+    for idx, string in enumerate(encoded):
+        string_hash = mmh3.hash(string, signed=False)
+        slot = string_hash & mask
+        while slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        slots[slot] = idx
+        hashes[slot] = string_hash
+
+    return offsets, data, slots, hashes
+
+
+def write_compiled_vocab(path: str, words: List[str], stem_mapping: dict):
+    """
+    Args:
+        path: path of the compiled vocab
+        words: words in the order of vocab ids, same as `vocab` of the JSON file
+        stem_mapping: stem -> word, same as `stem_mapping` of the JSON file
+    """
+    if len(set(words)) != len(words):
+        raise ValueError("Vocab contains duplicate words")
+
+    word_ids = {word: idx + 1 for idx, word in enumerate(words)}
+    stems = list(stem_mapping.keys())
+
+    word_offsets, word_bytes, word_slots, word_hashes = _encode_strings(words)
+    stem_offsets, stem_bytes, stem_slots, stem_hashes = _encode_strings(stems)
+    stem_word_ids = np.array([word_ids[stem_mapping[stem]] for stem in stems], dtype=np.int32)
+
+    sections = {
+        "word_offsets": word_offsets,
+        "word_bytes": word_bytes,
+        "word_slots": word_slots,
+        "word_hashes": word_hashes,
+        "stem_offsets": stem_offsets,
+        "stem_bytes": stem_bytes,
+        "stem_slots": stem_slots,
+        "stem_hashes": stem_hashes,
+        "stem_word_ids": stem_word_ids,
+    }
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(COMPILED_VOCAB_MAGIC)
+        f.write(np.array([len(sections[name]) for name, _, _ in SECTIONS], dtype="<u8").tobytes())
+        for name, dtype, _ in SECTIONS:
+            data = np.ascontiguousarray(sections[name], dtype=dtype).tobytes()
+            f.write(data)
+            f.write(b"\0" * (_aligned(len(data)) - len(data)))
+    os.replace(tmp_path, path)
+
+
+def is_compiled_vocab(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(COMPILED_VOCAB_MAGIC)) == COMPILED_VOCAB_MAGIC
+
+
+class StringTable:
+    """
+    Strings with a hash index over them, backed by the mapped file
+    """
+
+    def __init__(self, buffer: mmap.mmap, data_start: int, offsets: memoryview, slots: memoryview, hashes: memoryview):
+        """
+        Args:
+            buffer: mapped file
+            data_start: position of the concatenated strings in the file
+            offsets: string `i` occupies [offsets[i], offsets[i + 1]) after `data_start`
+            slots: index of the string in each slot of the hash table
+            hashes: hash of the string in each slot
+        """
+        self.buffer = buffer
+        self.data_start = data_start
+        self.offsets = offsets
+        self.slots = slots
+        self.hashes = hashes
+        self.mask = len(slots) - 1
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _bytes(self, idx: int) -> bytes:
+        # Slicing the mmap is faster than slicing a memoryview and comparing it
+        return self.buffer[self.data_start + self.offsets[idx]:self.data_start + self.offsets[idx + 1]]
+
+    def string(self, idx: int) -> str:
+        return self._bytes(idx).decode("utf-8")
+
+    def index(self, string: str) -> int:
+        """
+        Index of the string, -1 if it is not in the table
+        """
+        encoded = string.encode("utf-8")
+        string_hash = mmh3.hash(encoded, signed=False)
+
+        # Hot path, attributes are bound to locals
+        slots, hashes, offsets, buffer, data_start, mask = (
+            self.slots, self.hashes, self.offsets, self.buffer, self.data_start, self.mask
+        )
+        slot = string_hash & mask
+        while True:
+            idx = slots[slot]
+            if idx < 0:
+                return -1
+            if hashes[slot] == string_hash and buffer[data_start + offsets[idx]:data_start + offsets[idx + 1]] == encoded:
+                return idx
+            slot = (slot + 1) & mask
+
+
+class CompiledWords:
+    """
+    Read-only replacement of `VocabResolver.words`: word by `vocab_id - 1`
+    """
+
+    def __init__(self, table: StringTable):
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self.table)
+        if not 0 <= idx < len(self.table):
+            raise IndexError(idx)
+        return self.table.string(idx)
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self.table)):
+            yield self.table.string(idx)
+
+
+class CompiledWordIds:
+    """
+    Read-only replacement of `VocabResolver.vocab`: word -> vocab id
+    """
+
+    def __init__(self, table: StringTable):
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def get(self, word: str, default: Optional[int] = None) -> Optional[int]:
+        idx = self.table.index(word)
+        return idx + 1 if idx >= 0 else default
+
+    def __contains__(self, word: str) -> bool:
+        return self.table.index(word) >= 0
+
+    def __getitem__(self, word: str) -> int:
+        idx = self.table.index(word)
+        if idx < 0:
+            raise KeyError(word)
+        return idx + 1
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self.table)):
+            yield self.table.string(idx)
+
+
+class CompiledStemMapping:
+    """
+    Read-only replacement of `VocabResolver.stem_mapping`: stem -> word
+    """
+
+    def __init__(self, table: StringTable, word_ids: memoryview, words: CompiledWords):
+        self.table = table
+        self.word_ids = word_ids
+        self.words = words
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def get(self, stem: str, default: Optional[str] = None) -> Optional[str]:
+        idx = self.table.index(stem)
+        return self.words[self.word_ids[idx] - 1] if idx >= 0 else default
+
+    def __contains__(self, stem: str) -> bool:
+        return self.table.index(stem) >= 0
+
+    def __getitem__(self, stem: str) -> str:
+        word = self.get(stem)
+        if word is None:
+            raise KeyError(stem)
+        return word
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self.table)):
+            yield self.table.string(idx)
+
+
+class CompiledVocab:
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buffer = memoryview(self.mmap)
+        if bytes(buffer[:len(COMPILED_VOCAB_MAGIC)]) != COMPILED_VOCAB_MAGIC:
+            raise ValueError(f"{path} is not a compiled vocab")
+
+        sizes = np.frombuffer(self.mmap, dtype="<u8", count=len(SECTIONS), offset=len(COMPILED_VOCAB_MAGIC)).tolist()
+
+        sections = {}
+        starts = {}
+        offset = HEADER_SIZE
+        for (name, dtype, view_format), size in zip(SECTIONS, sizes):
+            nbytes = size * np.dtype(dtype).itemsize
+            # Memoryview indexing returns Python ints, which is faster than indexing numpy arrays one element at a time
+            sections[name] = buffer[offset:offset + nbytes].cast(view_format)
+            starts[name] = offset
+            offset += _aligned(nbytes)
+
+        word_table = StringTable(
+            self.mmap, starts["word_bytes"], sections["word_offsets"], sections["word_slots"], sections["word_hashes"]
+        )
+        stem_table = StringTable(
+            self.mmap, starts["stem_bytes"], sections["stem_offsets"], sections["stem_slots"], sections["stem_hashes"]
+        )
+
+        self.words = CompiledWords(word_table)
+        self.vocab = CompiledWordIds(word_table)
+        self.stem_mapping = CompiledStemMapping(stem_table, sections["stem_word_ids"], self.words)
+
+    def token_vocab_ids_path(self, tokens: List[str]) -> str:
+        tokenizer_hash = hashlib.sha256("\n".join(tokens).encode("utf-8")).hexdigest()[:16]
+        return f"{self.path}.{tokenizer_hash}.tokens.npy"
+
+    def load_token_vocab_ids(self, tokens: List[str]) -> Optional[np.ndarray]:
+        """
+        Vocab ids of tokens of the tokenizer vocabulary, if they were saved for this version of the vocab
+        """
+        path = self.token_vocab_ids_path(tokens)
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(self.path):
+            return None
+
+        token_vocab_ids = np.load(path, mmap_mode="r")
+        if len(token_vocab_ids) != len(tokens):
+            return None
+        return token_vocab_ids
+
+    def save_token_vocab_ids(self, tokens: List[str], token_vocab_ids: np.ndarray):
+        path = self.token_vocab_ids_path(tokens)
+        tmp_path = path + ".tmp.npy"
+        try:
+            np.save(tmp_path, token_vocab_ids)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Read-only location, tokens are resolved again next time
+            pass
+
+
+def test_compiled_vocab():
+    import tempfile
+
+    words = ["bat", "cave", "naïve", "café", "swim", ""]
+    stem_mapping = {"bat": "bat", "swim": "swim", "swimming": "swim", "caf": "café"}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "vocab.bin")
+        write_compiled_vocab(path, words, stem_mapping)
+        assert is_compiled_vocab(path)
+
+        vocab = CompiledVocab(path)
+        assert len(vocab.vocab) == len(words)
+        assert list(vocab.words) == words
+        assert vocab.words[2] == "naïve"
+        assert vocab.words[-1] == ""
+
+        for idx, word in enumerate(words):
+            assert word in vocab.vocab
+            assert vocab.vocab[word] == idx + 1
+        assert vocab.vocab.get("dog") is None
+        assert "dog" not in vocab.vocab
+        assert "naive" not in vocab.vocab
+
+        assert vocab.stem_mapping["swimming"] == "swim"
+        assert vocab.stem_mapping.get("caf") == "café"
+        assert "cav" not in vocab.stem_mapping
+        assert sorted(vocab.stem_mapping) == sorted(stem_mapping)
+
+        tokens = ["bat", "##s", "swimming"]
+        assert vocab.load_token_vocab_ids(tokens) is None
+        vocab.save_token_vocab_ids(tokens, np.array([1, 0, 5]))
+        assert vocab.load_token_vocab_ids(tokens).tolist() == [1, 0, 5]
+        assert vocab.load_token_vocab_ids(["bat", "##s"]) is None
+
+        empty_path = os.path.join(tmp_dir, "empty.bin")
+        write_compiled_vocab(empty_path, [], {})
+        assert "bat" not in CompiledVocab(empty_path).vocab
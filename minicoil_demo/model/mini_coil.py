@@ -2,16 +2,20 @@
 End-to-end inference of the miniCOIL model.
 This includes sentence transformer, vocabulary resolver, and the coil post-encoder.
 """
-from dataclasses import dataclass
-import itertools
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from functools import cached_property
 import json
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
+from fastembed.common.onnx_model import OnnxOutputContext
+from fastembed.common.utils import iter_batch
 from fastembed.late_interaction.token_embeddings import TokenEmbeddingsModel
 
-from minicoil_demo.model.encoder import Encoder
-from minicoil_demo.model.vocab_resolver import VocabResolver, VocabTokenizerTokenizer
+from minicoil_demo.model.batching import length_buckets
+from minicoil_demo.model.encoder import Encoder, scales_path
+from minicoil_demo.model.vocab_resolver import VocabResolver, VocabTokenizerTokenizer, read_vocab
 
 
 
@@ -24,6 +28,104 @@ class WordEmbedding:
     embedding: List[float]
 
 
+@dataclass
+class SentenceEmbedding:
+    """
+    Array-based miniCOIL encoding of a single sentence.
+    Known words are kept as arrays, so no per-word objects are created on the indexing path.
+    """
+    # Size: (words) - vocab ids of known words, sorted
+    word_ids: np.ndarray
+    # Size: (words) - number of occurrences of each known word
+    counts: np.ndarray
+    # Size: (words, output_dim)
+    embeddings: np.ndarray
+    # Out-of-vocabulary words, including stopwords and special tokens
+    oov_words: List[str]
+    # Size: (oov_words) - number of occurrences of each out-of-vocabulary word
+    oov_counts: np.ndarray
+    # Forms of known words in the sentence, keyed by vocab word
+    forms: Dict[str, List[str]]
+    vocab_resolver: VocabResolver = field(repr=False)
+
+    @cached_property
+    def word_embeddings(self) -> Dict[str, WordEmbedding]:
+        """
+        Per-word view of the sentence, built on first access
+        """
+        sentence_result = {}
+
+        for word_id, count, emb in zip(self.word_ids.tolist(), self.counts.tolist(), self.embeddings):
+            word = self.vocab_resolver.lookup_word(word_id)
+
+            sentence_result[word] = WordEmbedding(
+                word=word,
+                forms=self.forms[word],
+                count=count,
+                word_id=word_id,
+                embedding=emb.tolist()
+            )
+
+        for oov_word, count in zip(self.oov_words, self.oov_counts.tolist()):
+            sentence_result[oov_word] = WordEmbedding(
+                word=oov_word,
+                forms=[oov_word],
+                count=count,
+                word_id=-1,
+                embedding=[1]
+            )
+
+        return sentence_result
+
+
+class TokenEmbeddingsBatchModel(TokenEmbeddingsModel):
+    """
+    Same as `TokenEmbeddingsModel`, but yields padded outputs of the whole batch
+    instead of splitting them into per-sentence embeddings.
+    """
+
+    def _post_process_onnx_output(self, output: OnnxOutputContext, **kwargs) -> Iterable[OnnxOutputContext]:
+        yield output
+
+    def tokenize_batch(self, documents: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Tokenize documents with the fast tokenizer, padded to the longest document.
+
+        Returns:
+            input_ids: (batch_size, seq_len)
+            attention_mask: (batch_size, seq_len) - 0 for padding tokens
+        """
+        encoded = self.tokenize(documents)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        return input_ids, attention_mask
+
+    def embed_tokens(self, input_ids: np.ndarray, attention_mask: np.ndarray, **kwargs) -> OnnxOutputContext:
+        """
+        Run the transformer on already tokenized documents.
+        """
+        if getattr(self, "model", None) is None:
+            self.load_onnx_model()
+
+        input_names = {node.name for node in self.model.get_inputs()}
+        onnx_input = {"input_ids": input_ids}
+        if "attention_mask" in input_names:
+            onnx_input["attention_mask"] = attention_mask
+        if "token_type_ids" in input_names:
+            onnx_input["token_type_ids"] = np.zeros_like(input_ids)
+
+        onnx_input = self._preprocess_onnx_input(onnx_input, **kwargs)
+        model_output = self._run_model(onnx_input=onnx_input, onnx_output_names=self.ONNX_OUTPUT_NAMES)
+
+        return OnnxOutputContext(
+            model_output=model_output,
+            attention_mask=attention_mask,
+            input_ids=input_ids,
+        )
+
+    def onnx_embed(self, documents: List[str], **kwargs) -> OnnxOutputContext:
+        return self.embed_tokens(*self.tokenize_batch(documents), **kwargs)
+
 
 class MiniCOIL:
 
@@ -32,101 +134,163 @@ class MiniCOIL:
             vocab_path: str,
             word_encoder_path: str,
             input_dim: int = 512,
-            sentence_encoder_model: str = "jinaai/jina-embeddings-v2-small-en-tokens"
+            sentence_encoder_model: str = "jinaai/jina-embeddings-v2-small-en-tokens",
+            encoder_mode: str = Encoder.MODE_GROUPED,
+            mmap_weights: bool = False,
+            threads: Optional[int] = 1,
+            concurrent_load: bool = False
     ):
+        """
+        Args:
+            threads: number of ONNX Runtime threads of the transformer, None to use all cores.
+                Ingestion scales with processes instead, so it defaults to 1
+            concurrent_load: load the transformer, the vocab and the word encoder weights in parallel threads.
+                Downloading the model, creating the ONNX session and reading weights release the GIL
+        """
         self.sentence_encoder_model = sentence_encoder_model
-        self.sentence_encoder = TokenEmbeddingsModel(model_name=sentence_encoder_model, threads=1)
-
         self.vocab_path = vocab_path
-        self.vocab_resolver = VocabResolver(tokenizer=VocabTokenizerTokenizer(self.sentence_encoder.tokenizer))
-        self.vocab_resolver.load_json_vocab(vocab_path)
 
         self.input_dim = input_dim
         self.output_dim = None
 
         self.word_encoder_path = word_encoder_path
+        self.encoder_mode = encoder_mode
+        # Memory-map weights instead of reading them into memory.
+        # Pages are loaded lazily and are shared between all processes using the same file.
+        self.mmap_weights = mmap_weights
 
         self.word_encoder = None
 
-        self.load_encoder_numpy()
+        if concurrent_load:
+            with ThreadPoolExecutor(max_workers=3, thread_name_prefix="minicoil-load") as executor:
+                sentence_encoder = executor.submit(TokenEmbeddingsBatchModel, model_name=sentence_encoder_model, threads=threads)
+                vocab_data = executor.submit(read_vocab, vocab_path)
+                word_encoder = executor.submit(self.load_encoder_numpy)
+
+                self.sentence_encoder = sentence_encoder.result()
+                vocab_data = vocab_data.result()
+                word_encoder.result()
+        else:
+            self.sentence_encoder = TokenEmbeddingsBatchModel(model_name=sentence_encoder_model, threads=threads)
+            vocab_data = read_vocab(vocab_path)
+            self.load_encoder_numpy()
+
+        # Vocab resolver needs the tokenizer of the transformer
+        self.vocab_resolver = VocabResolver(tokenizer=VocabTokenizerTokenizer(self.sentence_encoder.tokenizer))
+        self.vocab_resolver.load_vocab_data(vocab_data)
 
     def load_encoder_numpy(self):
-        weights = np.load(self.word_encoder_path)
-        self.word_encoder = Encoder(weights)
+        mmap_mode = "r" if self.mmap_weights else None
+        weights = np.load(self.word_encoder_path, mmap_mode=mmap_mode)
+
+        scales = None
+        if np.issubdtype(weights.dtype, np.integer):
+            # Quantized weights, see `minicoil_demo/tools/convert_weights.py`
+            scales = np.load(scales_path(self.word_encoder_path), mmap_mode=mmap_mode)
+
+        self.word_encoder = Encoder(weights, mode=self.encoder_mode, scales=scales)
         assert self.word_encoder.input_dim == self.input_dim
         self.output_dim = self.word_encoder.output_dim
 
-    def encode_steam(self, sentences: Iterable[str], parallel = None) -> Iterable[Dict[str, WordEmbedding]]:
-        
-        sentences1, sentences2 = itertools.tee(sentences, 2)
-        
-        for embedding, sentence in zip(self.sentence_encoder.embed(sentences1, batch_size=4, parallel=parallel), sentences2):
-            token_ids = np.array(self.sentence_encoder.tokenize([sentence])[0].ids)
-
-            word_ids, counts, oov, forms = self.vocab_resolver.resolve_tokens(token_ids)
-
-            # Size: (1, words)
-            word_ids = np.expand_dims(word_ids, axis=0)
-            # Size: (1, words, embedding_size)
-            embedding = np.expand_dims(embedding, axis=0)
-
-            assert word_ids.shape[1] == embedding.shape[1]
-            
-            # Size of word_ids_mapping: (unique_words, 2) - [vocab_id, batch_id]
-            # Size of embeddings: (unique_words, embedding_size)
-            ids_mapping, embeddings = self.word_encoder.forward(word_ids, embedding)
-
-            # Size of counts: (unique_words)
-            words_ids = ids_mapping[:, 0]
-
-            sentence_result = {}
-
-            words = [self.vocab_resolver.lookup_word(word_id) for word_id in words_ids]
-
-            for word, word_id, emb in zip(words, words_ids, embeddings):
-                if word_id == 0:
-                    continue
-
-                # sentence_result[word] = {
-                #     "word": word,
-                #     "forms": forms[word],
-                #     "count": int(counts[word_id]),
-                #     "word_id": int(word_id),
-                #     "embedding": emb.tolist()
-                # }
-
-                sentence_result[word] = WordEmbedding(
-                    word=word,
-                    forms=forms[word],
-                    count=int(counts[word_id]),
-                    word_id=int(word_id),
-                    embedding=emb.tolist()
-                )
-
-            for oov_word, count in oov.items():
-                # {
-                #     "word": oov_word,
-                #     "forms": [oov_word],
-                #     "count": int(count),
-                #     "word_id": -1,
-                #     "embedding": [1]
-                # }
-                sentence_result[oov_word] = WordEmbedding(
-                    word=oov_word,
-                    forms=[oov_word],
-                    count=int(count),
-                    word_id=-1,
-                    embedding=[1]
-                )
-            
-            yield sentence_result
-
-
-    def encode(self, sentences: list) -> List[Dict[str, WordEmbedding]]:
+    def encode_steam(self, sentences: Iterable[str], batch_size: int = 4, parallel = None) -> Iterable[SentenceEmbedding]:
+        """
+        Every batch is tokenized exactly once, the same token ids are fed into the transformer and the vocab resolver.
+        """
+        if parallel is not None:
+            # Transformer runs in fastembed worker processes, which return token ids along with the embeddings
+            for batch in self.sentence_encoder.embed(sentences, batch_size=batch_size, parallel=parallel):
+                yield from self.encode_batch(batch.input_ids, batch.attention_mask, batch.model_output)
+            return
+
+        for batch in iter_batch(sentences, batch_size):
+            token_ids, attention_mask = self.sentence_encoder.tokenize_batch(batch)
+            yield from self.encode_tokens(token_ids, attention_mask)
+
+    def encode_steam_bucketed(
+            self,
+            sentences: Iterable[str],
+            max_tokens: int = 4096,
+            max_batch_size: int = 64,
+            window_size: int = 1024
+    ) -> Iterable[SentenceEmbedding]:
+        """
+        Same as `encode_steam`, but instead of batching sentences in arrival order,
+        buffers `window_size` sentences and groups them into batches of similar length, see `length_buckets`.
+        Results are emitted in the original order.
+        """
+        for window in iter_batch(sentences, window_size):
+            # Padded to the longest sentence of the window, every batch is cut to its own longest sentence
+            token_ids, attention_mask = self.sentence_encoder.tokenize_batch(window)
+            lengths = attention_mask.sum(axis=1)
+
+            results: List[SentenceEmbedding] = [None] * len(window)
+            for rows in length_buckets(lengths, max_tokens=max_tokens, max_batch_size=max_batch_size):
+                seq_len = lengths[rows].max()
+                embeddings = self.encode_tokens(token_ids[rows, :seq_len], attention_mask[rows, :seq_len])
+                for row, embedding in zip(rows.tolist(), embeddings):
+                    results[row] = embedding
+
+            yield from results
+
+    def encode_tokens(self, token_ids: np.ndarray, attention_mask: np.ndarray) -> Iterable[SentenceEmbedding]:
+        """
+        Encode a padded batch of tokenized sentences, see `TokenEmbeddingsBatchModel.tokenize_batch`.
+        """
+        output = self.sentence_encoder.embed_tokens(token_ids, attention_mask)
+        yield from self.encode_batch(output.input_ids, output.attention_mask, output.model_output)
+
+    def encode_batch(
+            self,
+            token_ids: np.ndarray,
+            attention_mask: np.ndarray,
+            token_embeddings: np.ndarray
+    ) -> Iterable[SentenceEmbedding]:
+        """
+        Encode a padded batch of transformer outputs.
+
+        Args:
+            token_ids: (batch_size, seq_len) - ids of tokens, as fed into the transformer
+            attention_mask: (batch_size, seq_len) - 0 for padding tokens
+            token_embeddings: (batch_size, seq_len, input_dim) - token embeddings produced by the transformer
+        """
+        # Size: (batch_size, seq_len)
+        vocab_ids, counts, oov, forms = self.vocab_resolver.resolve_tokens_batch(token_ids, attention_mask)
+
+        assert vocab_ids.shape == token_embeddings.shape[:2]
+
+        # Size of ids_mapping: (unique_words, 2) - [vocab_id, batch_id]
+        # Size of embeddings: (unique_words, output_dim)
+        ids_mapping, embeddings = self.word_encoder.forward(vocab_ids, token_embeddings)
+
+        # Rows are sorted by vocab_id first, stable sort by batch_id keeps that order within each sentence
+        batch_ids = ids_mapping[:, 1]
+        order = np.argsort(batch_ids, kind="stable")
+        sentence_bounds = np.searchsorted(batch_ids[order], np.arange(1, vocab_ids.shape[0]))
+
+        for batch_id, rows in enumerate(np.split(order, sentence_bounds)):
+            words_ids = ids_mapping[rows, 0]
+            # Vocab id 0 is used for stopwords, unknown words and padding
+            known = words_ids != 0
+            words_ids = words_ids[known]
+
+            sentence_counts = counts[batch_id]
+            sentence_oov = oov[batch_id]
+
+            yield SentenceEmbedding(
+                word_ids=words_ids,
+                counts=np.fromiter((sentence_counts[word_id] for word_id in words_ids.tolist()), dtype=np.int64, count=len(words_ids)),
+                embeddings=embeddings[rows[known]],
+                oov_words=list(sentence_oov.keys()),
+                oov_counts=np.fromiter(sentence_oov.values(), dtype=np.int64, count=len(sentence_oov)),
+                forms=forms[batch_id],
+                vocab_resolver=self.vocab_resolver,
+            )
+
+    def encode(self, sentences: list, batch_size: int = 4) -> List[SentenceEmbedding]:
         """
         Encode the given word in the context of the sentences.
         """
-        return list(self.encode_steam(sentences))
+        return list(self.encode_steam(sentences, batch_size=batch_size))
 
 def main():
     import argparse
@@ -136,6 +300,9 @@ def main():
     parser.add_argument("--vocab-path", type=str)
     parser.add_argument("--word-encoder-path", type=str)
     parser.add_argument("--sentences", type=str, nargs='+')
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--encoder-mode", type=str, default=Encoder.MODE_GROUPED, choices=Encoder.MODES)
+    parser.add_argument("--mmap-weights", action="store_true")
     args = parser.parse_args()
 
     # Catch exception with ipdb
@@ -143,12 +310,14 @@ def main():
     with ipdb.launch_ipdb_on_exception():
         model = MiniCOIL(
             vocab_path=args.vocab_path,
-            word_encoder_path=args.word_encoder_path
+            word_encoder_path=args.word_encoder_path,
+            encoder_mode=args.encoder_mode,
+            mmap_weights=args.mmap_weights
         )
 
-        for embeddings in model.encode(args.sentences):
-            for word, embedding in embeddings.items():
-                print(word, json.dumps(embedding))
+        for embeddings in model.encode(args.sentences, batch_size=args.batch_size):
+            for word, embedding in embeddings.word_embeddings.items():
+                print(word, json.dumps(asdict(embedding)))
 
 
 if __name__ == '__main__':
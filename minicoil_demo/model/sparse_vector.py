@@ -1,11 +1,12 @@
-
-from typing import Dict, List
-from minicoil_demo.model.mini_coil import MiniCOIL, WordEmbedding
+from dataclasses import asdict, replace
+from typing import Dict, List, Optional, Tuple, Union
+from minicoil_demo.model.cache import LRUCache
+from minicoil_demo.model.mini_coil import MiniCOIL, SentenceEmbedding, WordEmbedding
 from py_rust_stemmers import SnowballStemmer
 from minicoil_demo.model.stopwords import english_stopwords
 from fastembed.common.utils import get_all_punctuation, remove_non_alphanumeric
 import mmh3
-import copy
+import numpy as np
 
 from qdrant_client import models
 
@@ -14,7 +15,7 @@ INT32_MAX = 2**31 - 1
 
 class SparseVectorConverter:
 
-    def __init__(self, k: float = 1.2, b: float = 0.75, avg_len: float = 150.0):
+    def __init__(self, k: float = 1.2, b: float = 0.75, avg_len: float = 150.0, oov_cache_size: int = 2 ** 16):
         punctuation = set(get_all_punctuation())
         special_tokens = set(['[CLS]', '[SEP]', '[PAD]', '[UNK]', '[MASK]'])
         
@@ -25,15 +26,26 @@ class SparseVectorConverter:
         self.b = b
         self.avg_len = avg_len
 
+        # OOV vocabulary of a corpus is heavily skewed, so the same words are normalized and hashed over and over again.
+        # Maps raw OOV word to its stemmed subwords and their hashes, shared by document and query conversion.
+        self.oov_cache = LRUCache(maxsize=oov_cache_size)
+
 
     @classmethod
-    def unkn_word_token_id(cls, word: str, shift: int) -> int:  #2-3 words can collide in 1 index with this mapping, not considering mm3 collisions
-        token_hash = abs(mmh3.hash(word))
+    def word_hash(cls, word: str) -> int:
+        return abs(mmh3.hash(word))
 
+    @classmethod
+    def remap_hash(cls, token_hash, shift: int):
+        """
+        Map hash (or an array of hashes) into the scope of OOV words
+        """
         range_size = INT32_MAX - shift
-        remapped_hash = shift + (token_hash % range_size)
+        return shift + (token_hash % range_size)
 
-        return remapped_hash
+    @classmethod
+    def unkn_word_token_id(cls, word: str, shift: int) -> int:  #2-3 words can collide in 1 index with this mapping, not considering mm3 collisions
+        return cls.remap_hash(cls.word_hash(word), shift)
 
 
     def bm25_tf(self, num_occurrences: int, sentence_len: int) -> float:
@@ -80,36 +92,284 @@ class SparseVectorConverter:
             if embedding.word_id > 0:
                 # Known word, no need to clean
                 new_sentence_embedding[word] = embedding
-            else:
-                # Unknown word
-                if word in self.unwanted_tokens:
-                    continue
-
-                # Example complex word split: 
-                # word = `word^vec`
-                word_cleaned = remove_non_alphanumeric(word).strip()
-                # word_cleaned = `word vec`
-
-                if len(word_cleaned) > 0:
-                    # Subwords: ['word', 'vec']
-                    for subword in word_cleaned.split():
-                        stemmed_subword = self.stemmer.stem_word(subword)
-                        if len(stemmed_subword) <= token_max_length and stemmed_subword not in self.unwanted_tokens:
-                            if stemmed_subword not in new_sentence_embedding:
-                                new_sentence_embedding[stemmed_subword] = copy.deepcopy(embedding)
-                                new_sentence_embedding[stemmed_subword].word = stemmed_subword
-                            else:
-                                new_sentence_embedding[stemmed_subword].count += embedding.count
-                                new_sentence_embedding[stemmed_subword].forms += embedding.forms
+                continue
+
+            # Unknown word
+            for stemmed_subword in self.normalize_oov_word(word, token_max_length):
+                existing_embedding = new_sentence_embedding.get(stemmed_subword)
+                if existing_embedding is None:
+                    new_sentence_embedding[stemmed_subword] = WordEmbedding(
+                        word=stemmed_subword,
+                        forms=list(embedding.forms),
+                        count=embedding.count,
+                        word_id=embedding.word_id,
+                        embedding=embedding.embedding
+                    )
+                else:
+                    # Input embeddings are never modified, merged entry is a new object
+                    new_sentence_embedding[stemmed_subword] = replace(
+                        existing_embedding,
+                        count=existing_embedding.count + embedding.count,
+                        forms=existing_embedding.forms + embedding.forms
+                    )
         
         return new_sentence_embedding
 
+    def _normalize_oov_word(self, word: str, token_max_length: int = 40) -> Tuple[str, ...]:
+        """
+        Split unknown word into stemmed subwords, the same way BM25 tokenizes it.
+        Subwords, which are not wanted in the sparse vector, are dropped.
+
+        Example: `word^vecs` -> ('word', 'vec')
+        """
+        if word in self.unwanted_tokens:
+            return ()
+
+        # word = `word^vecs`
+        word_cleaned = remove_non_alphanumeric(word).strip()
+        # word_cleaned = `word vecs`
+
+        stemmed_subwords = []
+        # Subwords: ['word', 'vecs']
+        for subword in word_cleaned.split():
+            stemmed_subword = self.stemmer.stem_word(subword)
+            if len(stemmed_subword) <= token_max_length and stemmed_subword not in self.unwanted_tokens:
+                stemmed_subwords.append(stemmed_subword)
+
+        return tuple(stemmed_subwords)
+
+    def resolve_oov_word(self, word: str, token_max_length: int = 40) -> Tuple[Tuple[str, int], ...]:
+        """
+        Cached normalization of unknown word.
+
+        Returns:
+            stemmed subwords of the word with their hashes, see `word_hash`
+        """
+        key = (word, token_max_length)
+        resolved = self.oov_cache.get(key)
+        if resolved is None:
+            resolved = tuple(
+                (stemmed_subword, self.word_hash(stemmed_subword))
+                for stemmed_subword in self._normalize_oov_word(word, token_max_length)
+            )
+            self.oov_cache.put(key, resolved)
+        return resolved
+
+    def normalize_oov_word(self, word: str, token_max_length: int = 40) -> Tuple[str, ...]:
+        return tuple(stemmed_subword for stemmed_subword, _ in self.resolve_oov_word(word, token_max_length))
+
+    def _aggregate_oov_words(
+            self,
+            oov_words: List[str],
+            oov_counts: List[int],
+            token_max_length: int = 40
+    ) -> Tuple[Dict[str, int], Dict[str, int]]:
+        cleaned_counts = {}
+        hashes = {}
+        for word, count in zip(oov_words, oov_counts):
+            for stemmed_subword, token_hash in self.resolve_oov_word(word, token_max_length):
+                cleaned_counts[stemmed_subword] = cleaned_counts.get(stemmed_subword, 0) + count
+                hashes[stemmed_subword] = token_hash
+        return cleaned_counts, hashes
+
+    def clean_oov_words(self, oov_words: List[str], oov_counts: List[int], token_max_length: int = 40) -> Dict[str, int]:
+        """
+        Same as `clean_words`, but only for out-of-vocabulary words and their counts.
+
+        Returns:
+            number of occurrences of each stemmed subword
+        """
+        cleaned_counts, _hashes = self._aggregate_oov_words(oov_words, oov_counts, token_max_length)
+        return cleaned_counts
+
+    def document_length(self, word_counts: np.ndarray, oov_words: List[str], oov_counts: List[int]) -> float:
+        """
+        Length of the document, which `bm25_tf` is normalized by: known words and cleaned out-of-vocabulary words
+        """
+        return float(np.sum(word_counts) + sum(self.clean_oov_words(oov_words, oov_counts).values()))
+
 
-    def embedding_to_vector(self, model: MiniCOIL, sentence_embedding: Dict[str, WordEmbedding], token_max_length: int = 40) -> models.SparseVector:
+    @classmethod
+    def unknown_words_shift(cls, model: MiniCOIL) -> int:
+        """
+        ID at which the scope of OOV words starts
+        """
+        embedding_size = model.output_dim
+        vocab_size = model.vocab_resolver.vocab_size()
+        return ((vocab_size * embedding_size) // GAP + 2) * GAP #miniCOIL vocab + at least (GAP // embedding_size) + 1 new words gap
+
+    def sparse_arrays(
+            self,
+            model: MiniCOIL,
+            word_ids: np.ndarray,
+            word_counts: np.ndarray,
+            embeddings: np.ndarray,
+            oov_words: List[str],
+            oov_counts: np.ndarray,
+            query: bool = False,
+            oov_hashes: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Convert miniCOIL sentence embedding to Qdrant sparse vector
+        Convert encoded words into indices and values of a sparse vector, all words are processed at once.
+
+        Args:
+            model: miniCOIL model, which produced the embeddings
+            word_ids: (words) - miniCOIL vocab ids of known words
+            word_counts: (words) - number of occurrences of each known word
+            embeddings: (words, embedding_size) - miniCOIL embeddings of known words
+            oov_words: (oov_words) - cleaned out-of-vocabulary words, fallback to BM25
+            oov_counts: (oov_words) - number of occurrences of each out-of-vocabulary word
+            query: if True, no TF is applied
+            oov_hashes: (oov_words) - precomputed `word_hash` of each out-of-vocabulary word
+        """
+        embedding_size = model.output_dim
+        unknown_words_shift = self.unknown_words_shift(model)
+
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        word_counts = np.asarray(word_counts, dtype=np.float64)
+        oov_counts = np.asarray(oov_counts, dtype=np.float64)
+        embeddings = np.asarray(embeddings, dtype=np.float64).reshape(word_ids.shape[0], embedding_size)
+
+        if query:
+            word_tf = np.ones_like(word_counts)
+            oov_tf = np.ones_like(oov_counts)
+        else:
+            # Sentence length after cleaning
+            sentence_len = word_counts.sum() + oov_counts.sum()
+            word_tf = self.bm25_tf(word_counts, sentence_len)
+            oov_tf = self.bm25_tf(oov_counts, sentence_len)
+
+        # Size: (words, embedding_size)
+        normalized_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        # Each known word occupies `embedding_size` consecutive indices, since miniCOIL IDs start with 1
+        word_indices = word_ids[:, None] * embedding_size + np.arange(embedding_size)
+        word_values = normalized_embeddings * word_tf[:, None]
+
+        if oov_hashes is None:
+            oov_hashes = [self.word_hash(word) for word in oov_words]
+        oov_indices = self.remap_hash(np.asarray(oov_hashes, dtype=np.int64), unknown_words_shift)
+
+        indices = np.concatenate((word_indices.reshape(-1), oov_indices))
+        values = np.concatenate((word_values.reshape(-1), oov_tf))
+        return indices, values
+
+    def vector_from_arrays(
+            self,
+            model: MiniCOIL,
+            word_ids: np.ndarray,
+            word_counts: np.ndarray,
+            embeddings: np.ndarray,
+            oov_words: List[str],
+            oov_counts: np.ndarray,
+            query: bool = False,
+            oov_hashes: Optional[np.ndarray] = None
+    ) -> models.SparseVector:
+        """
+        Same as `sparse_arrays`, but returns Qdrant sparse vector
+        """
+        indices, values = self.sparse_arrays(
+            model,
+            word_ids=word_ids,
+            word_counts=word_counts,
+            embeddings=embeddings,
+            oov_words=oov_words,
+            oov_counts=oov_counts,
+            query=query,
+            oov_hashes=oov_hashes
+        )
+        return models.SparseVector(indices=indices.tolist(), values=values.tolist())
+
+    def sentence_embedding_to_arrays(
+            self,
+            model: MiniCOIL,
+            sentence_embedding: SentenceEmbedding,
+            query: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Convert `SentenceEmbedding` into indices and values of a sparse vector, without creating Qdrant objects.
+        Used to pass vectors between processes, see `minicoil_demo/tools/parallel_encoding.py`
+        """
+        word_ids = sentence_embedding.word_ids
+        word_counts = sentence_embedding.counts.astype(np.float64)
+
+        # Only out-of-vocabulary words need cleaning
+        cleaned_oov_counts, cleaned_oov_hashes = self._aggregate_oov_words(
+            sentence_embedding.oov_words,
+            sentence_embedding.oov_counts.tolist()
+        )
+
+        oov_words = []
+        oov_counts = []
+        oov_hashes = []
+        for word, count in cleaned_oov_counts.items():
+            # Cleaned word might coincide with a known word, its occurrences are merged then, same as in `clean_words`
+            vocab_id = model.vocab_resolver.vocab.get(word)
+            if vocab_id is not None:
+                position = np.searchsorted(word_ids, vocab_id)
+                if position < len(word_ids) and word_ids[position] == vocab_id:
+                    word_counts[position] += count
+                    continue
 
-        Example input:
+            oov_words.append(word)
+            oov_counts.append(count)
+            oov_hashes.append(cleaned_oov_hashes[word])
+
+        return self.sparse_arrays(
+            model,
+            word_ids=word_ids,
+            word_counts=word_counts,
+            embeddings=sentence_embedding.embeddings,
+            oov_words=oov_words,
+            oov_counts=np.array(oov_counts, dtype=np.float64),
+            query=query,
+            oov_hashes=np.array(oov_hashes, dtype=np.int64)
+        )
+
+    def _sentence_embedding_to_vector(
+            self,
+            model: MiniCOIL,
+            sentence_embedding: SentenceEmbedding,
+            query: bool
+    ) -> models.SparseVector:
+        indices, values = self.sentence_embedding_to_arrays(model, sentence_embedding, query)
+        return models.SparseVector(indices=indices.tolist(), values=values.tolist())
+
+    def _embedding_to_vector(
+            self,
+            model: MiniCOIL,
+            sentence_embedding: Union[SentenceEmbedding, Dict[str, WordEmbedding]],
+            query: bool
+    ) -> models.SparseVector:
+        if isinstance(sentence_embedding, SentenceEmbedding):
+            return self._sentence_embedding_to_vector(model, sentence_embedding, query)
+
+        sentence_embedding_cleaned = self.clean_words(sentence_embedding)
+
+        known_words = []
+        oov_words = []
+        for embedding in sentence_embedding_cleaned.values():
+            if embedding.word_id >= 0: #miniCOIL starts with ID 1
+                known_words.append(embedding)
+            else:
+                oov_words.append(embedding)
+
+        return self.vector_from_arrays(
+            model,
+            word_ids=np.array([embedding.word_id for embedding in known_words], dtype=np.int64),
+            word_counts=np.array([embedding.count for embedding in known_words], dtype=np.float64),
+            embeddings=np.array([embedding.embedding for embedding in known_words], dtype=np.float64),
+            oov_words=[embedding.word for embedding in oov_words],
+            oov_counts=np.array([embedding.count for embedding in oov_words], dtype=np.float64),
+            query=query
+        )
+
+    def embedding_to_vector(self, model: MiniCOIL, sentence_embedding: Union[SentenceEmbedding, Dict[str, WordEmbedding]], token_max_length: int = 40) -> models.SparseVector:
+        """
+        Convert miniCOIL sentence embedding to Qdrant sparse vector.
+        `SentenceEmbedding` is converted without creating per-word objects for known words.
+
+        Example input in per-word form:
         
         ```
         {
@@ -130,78 +390,84 @@ class SparseVectorConverter:
         ```
 
         """
+        return self._embedding_to_vector(model, sentence_embedding, query=False)
 
 
-        indices = []
-        values = []
-        
-        embedding_size = model.output_dim
-        vocab_size = model.vocab_resolver.vocab_size()
+    def embedding_to_vector_query(self, model: MiniCOIL, sentence_embedding: Union[SentenceEmbedding, Dict[str, WordEmbedding]], token_max_length: int = 40) -> models.SparseVector:
+        """
+        Same as `embedding_to_vector`, but no TF
+        """
+        return self._embedding_to_vector(model, sentence_embedding, query=True)
 
-        # ID at which the scope of OOV words starts
-        unknown_words_shift = ((vocab_size * embedding_size) // GAP + 2) * GAP #miniCOIL vocab + at least (GAP // embedding_size) + 1 new words gap
 
-        sentence_embedding_cleaned = self.clean_words(sentence_embedding)
+def pack_sparse_vector(indices: np.ndarray, values: np.ndarray) -> bytes:
+    """
+    Compact binary encoding of a sparse vector, all numbers are little-endian:
 
-        # Calcualte sentence length after cleaning
-        sentence_len = 0
-        for embedding in sentence_embedding_cleaned.values():
-            sentence_len += embedding.count
+        uint32 - number of elements `n`
+        n * uint32 - indices
+        n * float32 - values
+    """
+    return (
+        np.array([len(indices)], dtype="<u4").tobytes()
+        + np.asarray(indices, dtype="<u4").tobytes()
+        + np.asarray(values, dtype="<f4").tobytes()
+    )
 
-        for embedding in sentence_embedding_cleaned.values():
-            word_id = embedding.word_id
-            num_occurences = embedding.count
-            tf = self.bm25_tf(num_occurences, sentence_len)
-            
-            if word_id >= 0: #miniCOIL starts with ID 1
-                embedding = embedding.embedding
-                normalized_embedding = self.normalize_vector(embedding)
-            
-                for val_id, value in enumerate(normalized_embedding):
-                    indices.append(word_id * embedding_size + val_id) #since miniCOIL IDs start with 1
-                    values.append(value * tf)
-            else:
-                indices.append(self.unkn_word_token_id(embedding.word, unknown_words_shift))
-                values.append(tf)
-        
-        return models.SparseVector(
-            indices=indices,
-            values=values,
-        )
 
+def unpack_sparse_vector(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    size = int(np.frombuffer(data, dtype="<u4", count=1)[0])
+    indices = np.frombuffer(data, dtype="<u4", count=size, offset=4)
+    values = np.frombuffer(data, dtype="<f4", count=size, offset=4 + 4 * size)
+    return indices, values
 
-    def embedding_to_vector_query(self, model: MiniCOIL, sentence_embedding: Dict[str, WordEmbedding], token_max_length: int = 40) -> models.SparseVector:
-        """
-        Same as `embedding_to_vector`, but no TF
-        """
 
-        indices = []
-        values = []
-        
-        embedding_size = model.output_dim
-        vocab_size = model.vocab_resolver.vocab_size()
+def test_pack_sparse_vector():
+    indices = np.array([3, 100500, INT32_MAX])
+    values = np.array([0.5, -1.25, 2.0])
 
-        # ID at which the scope of OOV words starts
-        unknown_words_shift = ((vocab_size * embedding_size) // GAP + 2) * GAP
+    data = pack_sparse_vector(indices, values)
+    assert len(data) == 4 + 3 * 8
 
-        sentence_embedding_cleaned = self.clean_words(sentence_embedding)
+    unpacked_indices, unpacked_values = unpack_sparse_vector(data)
+    assert unpacked_indices.tolist() == indices.tolist()
+    assert unpacked_values.tolist() == values.tolist()
 
-        for embedding in sentence_embedding_cleaned.values():
-            word_id = embedding.word_id
-            tf = 1.0
-            
-            if word_id >= 0: #miniCOIL starts with ID 1
-                embedding = embedding.embedding
-                normalized_embedding = self.normalize_vector(embedding)
-            
-                for val_id, value in enumerate(normalized_embedding):
-                    indices.append(word_id * embedding_size + val_id) #since miniCOIL IDs start with 1
-                    values.append(value * tf)
-            else:
-                indices.append(self.unkn_word_token_id(embedding.word, unknown_words_shift))
-                values.append(tf)
-        
-        return models.SparseVector(
-            indices=indices,
-            values=values,
-        )
+    assert [array.tolist() for array in unpack_sparse_vector(pack_sparse_vector([], []))] == [[], []]
+
+
+def test_clean_words():
+    converter = SparseVectorConverter()
+
+    sentence_embedding = {
+        "9°": WordEmbedding(word="9°", forms=["9°"], count=2, word_id=-1, embedding=[1]),
+        "9": WordEmbedding(word="9", forms=["9"], count=2, word_id=-1, embedding=[1]),
+        "bat": WordEmbedding(word="bat", forms=["bats", "bat"], count=3, word_id=2, embedding=[0.2, 0.1, -0.2, -0.2]),
+        "9°9": WordEmbedding(word="9°9", forms=["9°9"], count=1, word_id=-1, embedding=[1]),
+        "screech": WordEmbedding(word="screech", forms=["screech"], count=1, word_id=-1, embedding=[1]),
+        "screeched": WordEmbedding(word="screeched", forms=["screeched"], count=1, word_id=-1, embedding=[1]),
+        "the": WordEmbedding(word="the", forms=["the"], count=4, word_id=-1, embedding=[1]),
+    }
+
+    expected = {
+        "9": {"word": "9", "word_id": -1, "count": 6, "embedding": [1], "forms": ["9°", "9", "9°9", "9°9"]},
+        "bat": {"word": "bat", "word_id": 2, "count": 3, "embedding": [0.2, 0.1, -0.2, -0.2], "forms": ["bats", "bat"]},
+        "screech": {"word": "screech", "word_id": -1, "count": 2, "embedding": [1], "forms": ["screech", "screeched"]},
+    }
+
+    # Cleaning twice makes sure that cached normalization and merging don't modify the input
+    for _ in range(2):
+        cleaned = converter.clean_words(sentence_embedding)
+        assert {word: asdict(embedding) for word, embedding in cleaned.items()} == expected
+
+    assert sentence_embedding["9"].count == 2
+    assert sentence_embedding["9"].forms == ["9"]
+
+    oov_words = [word for word, embedding in sentence_embedding.items() if embedding.word_id < 0]
+    oov_counts = [sentence_embedding[word].count for word in oov_words]
+
+    assert converter.clean_oov_words(oov_words, oov_counts) == {"9": 6, "screech": 2}
+
+    # Each raw OOV word is normalized once, the rest are cache hits
+    assert converter.oov_cache.misses == len(oov_words)
+    assert converter.oov_cache.hits == 2 * len(oov_words)
@@ -1,12 +1,17 @@
+import os
 from collections import defaultdict
-from typing import Iterable, Tuple, List
+from typing import Iterable, Tuple, List, Optional, Union
 
 from py_rust_stemmers import SnowballStemmer
 
 import numpy as np
 from tokenizers import Tokenizer
+from minicoil_demo.model.cache import LRUCache
+from minicoil_demo.model.compiled_vocab import CompiledVocab, is_compiled_vocab
 from minicoil_demo.model.stopwords import english_stopwords
 
+CONTINUING_SUBWORD_PREFIX = "##"
+
 
 class VocabTokenizer:
 
@@ -16,6 +21,9 @@ class VocabTokenizer:
     def convert_ids_to_tokens(self, token_ids: np.ndarray) -> list:
         raise NotImplementedError()
 
+    def vocab_size(self) -> int:
+        raise NotImplementedError()
+
 
 class VocabTokenizerTokenizer(VocabTokenizer):
     def __init__(self, tokenizer: Tokenizer):
@@ -27,9 +35,41 @@ class VocabTokenizerTokenizer(VocabTokenizer):
     def convert_ids_to_tokens(self, token_ids: np.ndarray) -> list:
         return [self.tokenizer.id_to_token(token_id) for token_id in token_ids]
 
+    def vocab_size(self) -> int:
+        return self.tokenizer.get_vocab_size()
+
+
+def read_json_vocab(path: str) -> dict:
+    """
+    Parse a `.vocab` file: `{"vocab": [word, ...], "stem_mapping": {stem: word}}`.
+    Doesn't need the tokenizer, so it can run while the transformer is loading
+    """
+    import json
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def compiled_vocab_path(path: str) -> str:
+    return path + ".bin"
+
+
+def read_vocab(path: str) -> Union[dict, CompiledVocab]:
+    """
+    Read a compiled vocab, if `path` is one or if it is compiled next to the JSON file, see `compile_vocab.py`.
+    Parse the JSON file otherwise
+    """
+    if is_compiled_vocab(path):
+        return CompiledVocab(path)
+
+    compiled_path = compiled_vocab_path(path)
+    if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(path):
+        return CompiledVocab(compiled_path)
+
+    return read_json_vocab(path)
+
 
 class VocabResolver:
-    def __init__(self, tokenizer: VocabTokenizer):
+    def __init__(self, tokenizer: VocabTokenizer, word_cache_size: int = 2 ** 16):
         # Word to id mapping
         self.vocab = {}
         # Id to word mapping
@@ -37,8 +77,17 @@ class VocabResolver:
         # Lemma to word mapping
         self.stem_mapping = {}
         self.tokenizer: VocabTokenizer = tokenizer
+        # Set if the vocab is loaded from a compiled file, see `load_vocab_data`
+        self.compiled_vocab: Optional[CompiledVocab] = None
         self.stemmer = SnowballStemmer("english")
 
+        # Lookup tables over the tokenizer vocabulary, built on first use, see `build_token_tables`
+        self.token_strings: Optional[List[str]] = None
+        self.token_is_continuation: Optional[np.ndarray] = None
+        self.token_vocab_ids: Optional[np.ndarray] = None
+        # Vocab ids of words, which consist of several tokens
+        self.word_cache = LRUCache(maxsize=word_cache_size)
+
 
     def tokenize(self, sentence: str) -> np.ndarray:
         return self.tokenizer.tokenize(sentence)
@@ -68,12 +117,25 @@ class VocabResolver:
             }, f, indent=2)
 
     def load_json_vocab(self, path):
-        import json
-        with open(path, "r") as f:
-            data = json.load(f)
+        self.load_vocab_data(read_json_vocab(path))
+
+    def load_vocab_data(self, data: Union[dict, CompiledVocab]):
+        """
+        Args:
+            data: parsed vocab file, see `read_json_vocab`, or a compiled vocab.
+                Compiled vocab is read-only, `add_word` can't be used with it
+        """
+        if isinstance(data, CompiledVocab):
+            self.compiled_vocab = data
+            self.words = data.words
+            self.vocab = data.vocab
+            self.stem_mapping = data.stem_mapping
+        else:
+            self.compiled_vocab = None
             self.words = data["vocab"]
             self.vocab = {word: idx + 1 for idx, word in enumerate(self.words)}
             self.stem_mapping = data["stem_mapping"]
+        self.reset_token_tables()
 
 
     def add_word(self, word):
@@ -89,6 +151,64 @@ class VocabResolver:
                     # Prefer shorter words for the same stem
                     # Example: "swim" is preferred over "swimming"
                     self.stem_mapping[stem] = word
+            self.reset_token_tables()
+
+    def reset_token_tables(self):
+        self.token_strings = None
+        self.token_is_continuation = None
+        self.token_vocab_ids = None
+        self.word_cache.clear()
+
+    def build_token_tables(self):
+        """
+        Resolve every token of the tokenizer vocabulary as a standalone word, so that single-token words,
+        which are the vast majority, are resolved by array indexing.
+        """
+        tokens = self.convert_ids_to_tokens(range(self.tokenizer.vocab_size()))
+
+        self.token_strings = tokens
+        self.token_is_continuation = np.array(
+            [token.startswith(CONTINUING_SUBWORD_PREFIX) for token in tokens],
+            dtype=bool
+        )
+
+        if self.compiled_vocab is not None:
+            self.token_vocab_ids = self.compiled_vocab.load_token_vocab_ids(tokens)
+            if self.token_vocab_ids is not None:
+                return
+
+        self.token_vocab_ids = np.array(
+            [0 if is_continuation else self.resolve_word(token) for token, is_continuation in zip(tokens, self.token_is_continuation)],
+            dtype=np.int64
+        )
+
+        if self.compiled_vocab is not None:
+            self.compiled_vocab.save_token_vocab_ids(tokens, self.token_vocab_ids)
+
+    def resolve_word(self, word: str) -> int:
+        """
+        Vocab id of the word, 0 if word is unknown or a stopword
+        """
+        if word in english_stopwords:
+            return 0
+        # Single lookup per mapping, lookups in a compiled vocab are not free
+        vocab_id = self.vocab.get(word)
+        if vocab_id is not None:
+            return vocab_id
+        stem_word = self.stem_mapping.get(word)
+        if stem_word is not None:
+            return self.vocab[stem_word]
+        stem_word = self.stem_mapping.get(self.stemmer.stem_word(word))
+        if stem_word is not None:
+            return self.vocab[stem_word]
+        return 0
+
+    def _resolve_composed_word(self, word: str) -> int:
+        vocab_id = self.word_cache.get(word)
+        if vocab_id is None:
+            vocab_id = self.resolve_word(word)
+            self.word_cache.put(word, vocab_id)
+        return vocab_id
 
     def load_vocab(self, path):
         with open(path, "r") as f:
@@ -103,7 +223,7 @@ class VocabResolver:
         acc = ""
         acc_idx = []
 
-        continuing_subword_prefix = "##"
+        continuing_subword_prefix = CONTINUING_SUBWORD_PREFIX
         continuing_subword_prefix_len = len(continuing_subword_prefix)
 
         for idx, token in bpe_tokens:
@@ -169,40 +289,91 @@ class VocabResolver:
 
         """
 
-        tokens = self.convert_ids_to_tokens(token_ids)
-        tokens_mapping = self._reconstruct_bpe(enumerate(tokens))
+        if self.token_vocab_ids is None:
+            self.build_token_tables()
 
         counts = defaultdict(int)
         oov_count = defaultdict(int)
 
         forms = defaultdict(list)
 
-        for token, mapped_token_ids in tokens_mapping:
-            vocab_id = 0
-            if token in english_stopwords:
-                vocab_id = 0
-            elif token in self.vocab:
-                vocab_id = self.vocab[token]
-                forms[token].append(token)
-            elif token in self.stem_mapping:
-                vocab_id = self.vocab[self.stem_mapping[token]]
-                forms[self.stem_mapping[token]].append(token)
-            else:
-                stem = self.stemmer.stem_word(token)
-                if stem in self.stem_mapping:
-                    vocab_id = self.vocab[self.stem_mapping[stem]]
-                    forms[self.stem_mapping[stem]].append(token)
-
-            for token_id in mapped_token_ids:
-                token_ids[token_id] = vocab_id
-
+        seq_len = token_ids.shape[0]
+        if seq_len == 0:
+            return token_ids, counts, oov_count, forms
+
+        # Each word starts with a non-continuation token, or at the beginning of the sequence
+        is_continuation = self.token_is_continuation[token_ids]
+        word_starts = ~is_continuation
+        word_starts[0] = True
+
+        start_positions = np.flatnonzero(word_starts)
+        end_positions = np.append(start_positions[1:], seq_len)
+        start_token_ids = token_ids[start_positions]
+
+        # Size: (words)
+        word_vocab_ids = self.token_vocab_ids[start_token_ids]
+        word_strings = [self.token_strings[token_id] for token_id in start_token_ids.tolist()]
+
+        # Words of several tokens are reconstructed and resolved by their string
+        composed_words = np.flatnonzero((end_positions - start_positions > 1) | is_continuation[start_positions])
+        for word_idx in composed_words.tolist():
+            word_token_ids = token_ids[start_positions[word_idx]:end_positions[word_idx]].tolist()
+            word = "".join(
+                self.token_strings[token_id][len(CONTINUING_SUBWORD_PREFIX):]
+                if self.token_is_continuation[token_id] else self.token_strings[token_id]
+                for token_id in word_token_ids
+            )
+            word_strings[word_idx] = word
+            word_vocab_ids[word_idx] = self._resolve_composed_word(word)
+
+        for word, vocab_id in zip(word_strings, word_vocab_ids.tolist()):
             if vocab_id == 0:
-                oov_count[token] += 1
+                oov_count[word] += 1
             else:
                 counts[vocab_id] += 1
+                forms[self.words[vocab_id - 1]].append(word)
+
+        # Every token of a word gets the vocab id of the word
+        token_ids[:] = word_vocab_ids[np.cumsum(word_starts) - 1]
 
         return token_ids, counts, oov_count, forms
 
+    def resolve_tokens_batch(
+            self,
+            token_ids: np.ndarray,
+            attention_mask: np.ndarray
+    ) -> Tuple[np.ndarray, List[dict], List[dict], List[dict]]:
+        """
+        Same as `resolve_tokens`, but for a padded batch of sequences.
+
+        Args:
+            token_ids: (batch_size, seq_len) - ids of tokens
+            attention_mask: (batch_size, seq_len) - 0 for padding tokens
+
+        Returns:
+            - vocab ids of tokens - (batch_size, seq_len), padding tokens are marked with 0
+            - counts of each token, per sequence
+            - oov counts of each token, per sequence
+            - forms of each token, per sequence
+        """
+        vocab_ids = np.zeros_like(token_ids)
+
+        counts = []
+        oov_counts = []
+        forms = []
+
+        for i in range(token_ids.shape[0]):
+            mask = attention_mask[i] != 0
+            # Fancy indexing makes a copy, so `resolve_tokens` doesn't modify the input
+            sequence_vocab_ids, sequence_counts, sequence_oov, sequence_forms = self.resolve_tokens(token_ids[i, mask])
+            vocab_ids[i, mask] = sequence_vocab_ids
+
+            counts.append(sequence_counts)
+            oov_counts.append(sequence_oov)
+            forms.append(sequence_forms)
+
+        return vocab_ids, counts, oov_counts, forms
+
     def token_ids_to_vocab_batch(self, token_ids: np.ndarray) -> np.ndarray:
         """
         Mark known tokens (including composed tokens) with vocab ids.
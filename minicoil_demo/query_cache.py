@@ -0,0 +1,223 @@
+"""
+Cache of query encodings for the service.
+
+Queries are looked up in an in-process LRU first, then, optionally, in a shared SQLite database,
+so that all `uvicorn --workers N` processes of a host benefit from each other's work.
+Cached values are responses ready to be returned, so a hit costs a dict lookup.
+
+SQLite calls block, so the service never makes them on the event loop: shared lookups are awaited
+in a dedicated thread with `QueryCache.get_async`, and writes are queued to the same thread by `QueryCache.put`.
+"""
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Tuple
+
+from minicoil_demo.model.cache import LRUCache
+
+# Expired and excess entries of the shared cache are removed every this many writes
+SHARED_CACHE_PRUNE_INTERVAL = 1000
+
+
+def normalize_query(query: str) -> str:
+    """
+    Queries differing only in whitespace produce the same tokens, so they share a cache entry.
+    Case is preserved, since original forms of words are a part of the response.
+    """
+    return " ".join(query.split())
+
+
+class SharedQueryCache:
+    """
+    Cache in a SQLite database, shared by processes on the same host. Values must be JSON-serializable.
+    """
+
+    def __init__(self, path: str, maxsize: int = 100_000, ttl: Optional[float] = None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.writes = 0
+
+        # Accessed from the cache thread of `QueryCache`, and from whatever thread collects stats
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS query_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM query_cache WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (key, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key: str, value: Any):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO query_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+            self.writes += 1
+            if self.writes % SHARED_CACHE_PRUNE_INTERVAL == 0:
+                self._prune()
+
+    def _prune(self):
+        self.connection.execute("DELETE FROM query_cache WHERE expires_at < ?", (time.time(),))
+        # `INSERT OR REPLACE` assigns a new rowid, so the oldest writes have the lowest ones
+        self.connection.execute(
+            "DELETE FROM query_cache WHERE rowid IN ("
+            "SELECT rowid FROM query_cache ORDER BY rowid DESC LIMIT -1 OFFSET ?"
+            ")",
+            (self.maxsize,)
+        )
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class QueryCache:
+    """
+    Two-level cache of query encodings, keyed by the model and the normalized query.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            maxsize: int = 10_000,
+            ttl: Optional[float] = 3600,
+            shared: Optional[SharedQueryCache] = None
+    ):
+        self.model_name = model_name
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.shared = shared
+        self.shared_hits = 0
+
+        # Single thread keeps writes in order, and a lookup after a write sees it
+        self.executor = None
+        if shared is not None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="minicoil-query-cache")
+
+    def key(self, query: str, kind: str = "embed") -> Tuple[str, str, str]:
+        """
+        Args:
+            query: text of the query
+            kind: type of the cached response, different endpoints cache different representations
+        """
+        return kind, self.model_name, normalize_query(query)
+
+    def _shared_hit(self, key: Tuple[str, str, str], value: Optional[Any]) -> Optional[Any]:
+        # Local cache is touched only by the caller's thread, never by the cache thread
+        if value is not None:
+            self.shared_hits += 1
+            self.local.put(key, value)
+        return value
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[Any]:
+        """
+        Blocking lookup, use `get_async` in the event loop
+        """
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        value = self.executor.submit(self.shared.get, "\t".join(key)).result()
+        return self._shared_hit(key, value)
+
+    async def get_async(self, key: Tuple[str, str, str]) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is not None or self.shared is None:
+            return value
+        value = await asyncio.get_running_loop().run_in_executor(self.executor, self.shared.get, "\t".join(key))
+        return self._shared_hit(key, value)
+
+    def put(self, key: Tuple[str, str, str], value: Any):
+        """
+        Never blocks: the write to the shared cache is queued to the cache thread
+        """
+        self.local.put(key, value)
+        if self.shared is not None:
+            self.executor.submit(self.shared.put, "\t".join(key), value)
+
+    def flush(self):
+        """
+        Wait for queued writes to the shared cache
+        """
+        if self.executor is not None:
+            self.executor.submit(lambda: None).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.shared is not None:
+            self.shared.close()
+
+    def stats(self) -> dict:
+        """
+        Counts entries of the shared cache, so it blocks
+        """
+        stats = {
+            "model_name": self.model_name,
+            "local": self.local.stats(),
+        }
+        if self.shared is not None:
+            stats["shared"] = {
+                "path": self.shared.path,
+                "size": len(self.shared),
+                "hits": self.shared_hits,
+            }
+        return stats
+
+
+def test_query_cache():
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "queries.sqlite")
+        first = QueryCache("model", maxsize=10, shared=SharedQueryCache(path))
+        second = QueryCache("model", maxsize=10, shared=SharedQueryCache(path))
+
+        key = first.key("  hello \n world ")
+        assert key == first.key("hello world")
+        assert first.key("hello world") != QueryCache("other").key("hello world")
+        assert first.key("hello world") != first.key("hello world", kind="vector")
+
+        assert first.get(key) is None
+        first.put(key, {"result": [1, 2]})
+        assert first.get(key) == {"result": [1, 2]}
+        first.flush()
+
+        # Another process finds it in the shared cache, and then locally
+        assert second.get(key) == {"result": [1, 2]}
+        assert second.get(key) == {"result": [1, 2]}
+        assert second.stats()["shared"]["hits"] == 1
+        assert second.stats()["local"]["hits"] == 1
+
+        other_key = first.key("other query")
+        first.put(other_key, {"result": []})
+        first.flush()
+
+        async def lookup():
+            return await second.get_async(other_key)
+
+        assert asyncio.run(lookup()) == {"result": []}
+
+        expiring = SharedQueryCache(path, ttl=-1)
+        expiring.put("expired", 1)
+        assert expiring.get("expired") is None
+
+        first.close()
+        second.close()
+        expiring.close()
@@ -1,15 +1,178 @@
+import asyncio
+from contextlib import asynccontextmanager
 from dataclasses import asdict
+import json
 import os
+from typing import AsyncIterator, List, Literal, Tuple
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastembed.common.utils import iter_batch
+from pydantic import BaseModel, Field
 from starlette.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 
+from minicoil_demo.batch_scheduler import MicroBatchScheduler
 from minicoil_demo.config import DATA_DIR, ROOT_DIR
-from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.model.mini_coil import MiniCOIL, SentenceEmbedding
+from minicoil_demo.model.sparse_vector import SparseVectorConverter, pack_sparse_vector
+from minicoil_demo.query_cache import QueryCache, SharedQueryCache
+from minicoil_demo.startup import ModelStartup
+
+model_name = os.getenv("MODEL_NAME", "minicoil.model")
+
+vocab_path = os.path.join(DATA_DIR, f"{model_name}.vocab")
+model_path = os.path.join(DATA_DIR, f"{model_name}.npy")
+
+transformer_model = "jinaai/jina-embeddings-v2-small-en-tokens"
+
+# With `uvicorn --workers N`, memory-mapped weights are shared between workers via page cache
+mmap_weights = os.getenv("MMAP_WEIGHTS", "true").lower() in ("1", "true", "yes")
+
+# ONNX Runtime threads per worker process, all cores by default. Set it to cores / workers with `uvicorn --workers N`
+model_threads = int(os.environ["MODEL_THREADS"]) if os.getenv("MODEL_THREADS") else None
+
+# Sizes of batches to run through the model before reporting readiness, empty to skip warmup
+warmup_batch_sizes = [int(size) for size in os.getenv("WARMUP_BATCH_SIZES", "1,8,32").split(",") if size.strip()]
+
+
+def load_model() -> MiniCOIL:
+    return MiniCOIL(
+        vocab_path=vocab_path,
+        word_encoder_path=model_path,
+        sentence_encoder_model=transformer_model,
+        mmap_weights=mmap_weights,
+        threads=model_threads,
+        concurrent_load=True
+    )
+
+
+def warmup_model(model: MiniCOIL, texts: List[str]):
+    for query_embedding in model.encode(texts, batch_size=len(texts)):
+        word_embeddings_response(query_embedding)
+        query_converter.sentence_embedding_to_arrays(model, query_embedding, query=True)
+
+
+# Model is loaded in the background after the server has started, see /api/health/ready
+startup = ModelStartup(load=load_model, warmup=warmup_model, warmup_batch_sizes=warmup_batch_sizes)
+
+# Number of queries cached in each worker process, 0 disables the cache
+query_cache_size = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+# Seconds, after which cached queries are re-encoded
+query_cache_ttl = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+# SQLite database shared by all worker processes of the host, e.g. `/dev/shm/minicoil-queries.sqlite`
+query_cache_path = os.getenv("QUERY_CACHE_PATH")
+# Number of queries kept in the shared database
+query_cache_shared_size = int(os.getenv("QUERY_CACHE_SHARED_SIZE", "100000"))
+
+query_cache = None
+if query_cache_size > 0:
+    query_cache = QueryCache(
+        model_name=model_name,
+        maxsize=query_cache_size,
+        ttl=query_cache_ttl,
+        shared=SharedQueryCache(
+            query_cache_path,
+            maxsize=query_cache_shared_size,
+            ttl=query_cache_ttl
+        ) if query_cache_path else None
+    )
+
+
+# Requests of /api/embed/batch with more texts are rejected
+batch_max_texts = int(os.getenv("BATCH_MAX_TEXTS", "10000"))
+# Texts of a batch request are grouped by length into transformer batches of this many tokens
+batch_max_tokens = int(os.getenv("BATCH_MAX_TOKENS", "8192"))
+# Batch requests are encoded in chunks of this many texts, queued queries are encoded in between.
+# Streamed responses send each chunk as soon as it is encoded
+batch_stream_chunk_size = int(os.getenv("BATCH_STREAM_CHUNK_SIZE", "256"))
+
+
+def word_embeddings_response(sentence_embedding: SentenceEmbedding) -> dict:
+    result = [
+        asdict(emb)
+        for emb in sentence_embedding.word_embeddings.values()
+    ]
+
+    return {
+        "result": result
+    }
+
+
+# Queries are not weighted with BM25, so `avg_len` doesn't matter
+query_converter = SparseVectorConverter()
+
+
+def query_vector_response(query_embedding: SentenceEmbedding) -> dict:
+    indices, values = query_converter.sentence_embedding_to_arrays(startup.model, query_embedding, query=True)
+    return {
+        "indices": indices.tolist(),
+        "values": values.tolist()
+    }
+
+
+def encode_queries(queries: List[Tuple[str, str]]) -> List[dict]:
+    """
+    Encode concurrent queries in one batch, runs in the inference thread.
+    Queries are pairs of response kind, "embed" or "sparse", and text
+    """
+    query_embeddings = startup.model.encode([text for _, text in queries], batch_size=len(queries))
+    return [
+        word_embeddings_response(query_empedding) if kind == "embed" else query_vector_response(query_empedding)
+        for (kind, _), query_empedding in zip(queries, query_embeddings)
+    ]
+
+
+class EmbedBatchRequest(BaseModel):
+    texts: List[str]
+    # "words" - per-word view, same as /api/embed; "sparse" - indices and values of Qdrant sparse vectors.
+    # Sent as `format`, the attribute is named differently not to shadow the builtin
+    encoding: Literal["words", "sparse"] = Field("words", alias="format")
+    # Sparse vectors of queries are not weighted with BM25, see `SparseVectorConverter.embedding_to_vector_query`
+    query: bool = True
+    # Average document length of the collection, used for BM25 weighting of documents
+    avg_len: float = 150.0
+    # Respond with NDJSON, one line per text, sent as soon as a chunk of texts is encoded
+    stream: bool = False
 
-app = FastAPI()
+
+def encode_batch_texts(texts: List[str], request: EmbedBatchRequest, converter: SparseVectorConverter) -> List[dict]:
+    """
+    Encode texts of a batch request in one pass, runs in the inference thread
+    """
+    mini_coil = startup.model
+    results = []
+    for sentence_embedding in mini_coil.encode_steam_bucketed(texts, max_tokens=batch_max_tokens):
+        if request.encoding == "words":
+            results.append(word_embeddings_response(sentence_embedding))
+        elif request.query:
+            results.append(query_vector_response(sentence_embedding))
+        else:
+            indices, values = converter.sentence_embedding_to_arrays(mini_coil, sentence_embedding)
+            results.append({"indices": indices.tolist(), "values": values.tolist()})
+    return results
+
+
+# Concurrent queries arriving within `BATCH_MAX_WAIT_MS` are encoded together
+scheduler = MicroBatchScheduler(
+    encode_queries,
+    max_batch_size=int(os.getenv("BATCH_MAX_SIZE", "32")),
+    max_wait=float(os.getenv("BATCH_MAX_WAIT_MS", "2")) / 1000
+)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    startup.start()
+    scheduler.start()
+    yield
+    await scheduler.stop()
+    if query_cache is not None:
+        query_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,34 +182,113 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model_name = os.getenv("MODEL_NAME", "minicoil.model")
 
-vocab_path = os.path.join(DATA_DIR, f"{model_name}.vocab")
-model_path = os.path.join(DATA_DIR, f"{model_name}.npy")
+def require_model():
+    if not startup.ready:
+        raise HTTPException(status_code=503, detail=f"Model is not ready: {startup.state}")
 
-transformer_model = "jinaai/jina-embeddings-v2-small-en-tokens"
 
-mini_coil = MiniCOIL(
-    vocab_path=vocab_path,
-    word_encoder_path=model_path,
-    sentence_encoder_model=transformer_model
-)
+async def encode_query(query: str, kind: str) -> dict:
+    cache_key = None
+    if query_cache is not None:
+        cache_key = query_cache.key(query, kind=kind)
+        cached = await query_cache.get_async(cache_key)
+        if cached is not None:
+            return cached
+
+    require_model()
+    response = await scheduler.submit((kind, query))
+
+    if query_cache is not None:
+        query_cache.put(cache_key, response)
+
+    return response
 
 
 @app.get("/api/embed")
 async def embed(query: str):
+    return await encode_query(query, kind="embed")
 
-    query_empedding = mini_coil.encode([query])[0]
 
-    result = [
-        asdict(emb)
-        for emb in query_empedding.values()
-    ]
+@app.get("/api/sparse")
+async def sparse(query: str, encoding: Literal["json", "binary"] = Query("json", alias="format")):
+    """
+    Query sparse vector, ready to be sent to Qdrant.
+    With `format=binary`, the vector is encoded with `pack_sparse_vector`, which is several times smaller than JSON
+    """
+    vector = await encode_query(query, kind="sparse")
+
+    if encoding == "binary":
+        return Response(content=pack_sparse_vector(vector["indices"], vector["values"]), media_type="application/octet-stream")
+
+    return vector
+
+
+async def encode_batch_chunks(request: EmbedBatchRequest, converter: SparseVectorConverter) -> AsyncIterator[List[dict]]:
+    # Chunks are separate jobs of the inference thread, so a large request doesn't hold up concurrent queries
+    for chunk in iter_batch(request.texts, batch_stream_chunk_size):
+        yield await scheduler.run(encode_batch_texts, chunk, request, converter)
+
+
+async def stream_batch(request: EmbedBatchRequest, converter: SparseVectorConverter) -> AsyncIterator[str]:
+    async for results in encode_batch_chunks(request, converter):
+        yield "".join(json.dumps(result) + "\n" for result in results)
+
+
+@app.post("/api/embed/batch")
+async def embed_batch(request: EmbedBatchRequest):
+    if len(request.texts) > batch_max_texts:
+        raise HTTPException(status_code=413, detail=f"At most {batch_max_texts} texts are allowed in a request")
+
+    require_model()
+
+    converter = SparseVectorConverter(avg_len=request.avg_len)
+
+    if request.stream:
+        return StreamingResponse(stream_batch(request, converter), media_type="application/x-ndjson")
+
+    results = []
+    async for chunk_results in encode_batch_chunks(request, converter):
+        results.extend(chunk_results)
 
     return {
-        "result": result
+        "results": results
     }
 
+
+@app.get("/api/health/live")
+async def live():
+    """
+    Liveness probe: the process serves requests. Fails only if the model can't be loaded, so that it is restarted
+    """
+    if startup.failed:
+        return JSONResponse(status_code=500, content=startup.status())
+    return {"status": "alive"}
+
+
+@app.get("/api/health/ready")
+async def ready():
+    """
+    Readiness probe: the model is loaded and warmed up
+    """
+    if not startup.ready:
+        return JSONResponse(status_code=503, content=startup.status())
+    return startup.status()
+
+
+@app.get("/api/cache")
+async def cache_stats():
+    if query_cache is None:
+        return {"enabled": False}
+    # Counting entries of the shared cache is a blocking query
+    stats = await asyncio.get_running_loop().run_in_executor(None, query_cache.stats)
+    return {"enabled": True, **stats}
+
+
+@app.get("/api/scheduler")
+async def scheduler_stats():
+    return scheduler.stats()
+
 app.mount("/", StaticFiles(directory=os.path.join(ROOT_DIR, 'frontend', 'dist'), html=True))
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+"""
+Model startup of the service.
+
+The model is loaded in a background thread after the server has started, so the server binds immediately
+and answers liveness probes, while readiness is reported only once the model is loaded and warmed up.
+Warmup runs a few batches of the expected sizes through the model, so that ONNX Runtime
+allocates its buffers before the first real request.
+"""
+import logging
+import threading
+import time
+from typing import Callable, Generic, List, Optional, TypeVar
+
+Model = TypeVar("Model")
+
+logger = logging.getLogger(__name__)
+
+# Queries for the warmup, varied in length and with out-of-vocabulary words
+WARMUP_QUERIES = [
+    "vector search",
+    "what is the capital of france",
+    "how do bats navigate in complete darkness using echolocation",
+    "covid-19 transmission rates among children in schools",
+    "qdrant sparse vectors bm25 minicoil",
+    "naïve café 9°",
+]
+
+
+class ModelStartup(Generic[Model]):
+    STATE_STARTING = "starting"
+    STATE_LOADING = "loading"
+    STATE_WARMING_UP = "warming_up"
+    STATE_READY = "ready"
+    STATE_FAILED = "failed"
+
+    def __init__(
+            self,
+            load: Callable[[], Model],
+            warmup: Optional[Callable[[Model, List[str]], object]] = None,
+            warmup_batch_sizes: List[int] = (1, 8, 32)
+    ):
+        """
+        Args:
+            load: creates the model
+            warmup: encodes a batch of texts with the model
+            warmup_batch_sizes: sizes of warmup batches, warmup is skipped if empty
+        """
+        self.load = load
+        self.warmup = warmup
+        self.warmup_batch_sizes = list(warmup_batch_sizes)
+
+        self.model: Optional[Model] = None
+        self.state = self.STATE_STARTING
+        self.error: Optional[str] = None
+        self.load_time: Optional[float] = None
+        self.warmup_time: Optional[float] = None
+
+        self.thread: Optional[threading.Thread] = None
+        self.ready_event = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="minicoil-startup", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.state = self.STATE_LOADING
+            start = time.perf_counter()
+            model = self.load()
+            self.load_time = time.perf_counter() - start
+
+            if self.warmup is not None and self.warmup_batch_sizes:
+                self.state = self.STATE_WARMING_UP
+                start = time.perf_counter()
+                for batch_size in self.warmup_batch_sizes:
+                    texts = [WARMUP_QUERIES[i % len(WARMUP_QUERIES)] for i in range(batch_size)]
+                    self.warmup(model, texts)
+                self.warmup_time = time.perf_counter() - start
+
+            # Model is published only when it is hot
+            self.model = model
+            self.state = self.STATE_READY
+        except Exception as e:
+            logger.exception("Failed to load the model")
+            # Only the type and the message are reported by the health endpoints, the traceback goes to the log
+            self.error = repr(e)
+            self.state = self.STATE_FAILED
+        finally:
+            self.ready_event.set()
+
+    @property
+    def ready(self) -> bool:
+        return self.state == self.STATE_READY
+
+    @property
+    def failed(self) -> bool:
+        return self.state == self.STATE_FAILED
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until the model is ready or failed to load, returns True if it is ready
+        """
+        self.ready_event.wait(timeout)
+        return self.ready
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "load_time": self.load_time,
+            "warmup_time": self.warmup_time,
+            "error": self.error,
+        }
+
+
+def test_model_startup():
+    warmup_batches = []
+
+    startup = ModelStartup(
+        load=lambda: "model",
+        warmup=lambda model, texts: warmup_batches.append((model, len(texts))),
+        warmup_batch_sizes=[1, 8]
+    )
+    assert not startup.ready
+    startup.start()
+    assert startup.wait(timeout=10)
+    assert startup.model == "model"
+    assert warmup_batches == [("model", 1), ("model", 8)]
+    assert startup.status()["state"] == ModelStartup.STATE_READY
+
+    def fail():
+        raise FileNotFoundError("minicoil.model.npy")
+
+    failing = ModelStartup(load=fail)
+    failing.start()
+    assert not failing.wait(timeout=10)
+    assert failing.failed
+    assert failing.status()["error"] == "FileNotFoundError('minicoil.model.npy')"
+    assert failing.model is None
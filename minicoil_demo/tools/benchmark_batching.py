@@ -0,0 +1,103 @@
+"""
+Compares arrival-order batching with length-bucketed batching on a BEIR corpus.
+
+Reports the share of transformer input occupied by padding for both strategies, and with `--throughput`
+measures the actual encoding speed of `MiniCOIL.encode_steam` vs `MiniCOIL.encode_steam_bucketed`,
+in documents and in real (not padded) tokens per second.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from minicoil_demo.config import DATA_DIR
+from minicoil_demo.model.batching import length_buckets, padded_size
+from minicoil_demo.model.encoder import Encoder
+from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.tools.benchmark_vocab_resolver import read_corpus
+
+DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
+
+
+def arrival_order_buckets(num_documents: int, batch_size: int):
+    return [np.arange(start, min(start + batch_size, num_documents)) for start in range(0, num_documents, batch_size)]
+
+
+def windowed_length_buckets(lengths: np.ndarray, max_tokens: int, max_batch_size: int, window_size: int):
+    buckets = []
+    for start in range(0, len(lengths), window_size):
+        window_buckets = length_buckets(lengths[start:start + window_size], max_tokens, max_batch_size)
+        buckets.extend(bucket + start for bucket in window_buckets)
+    return buckets
+
+
+def measure_time(encode, texts) -> float:
+    start = time.perf_counter()
+    for _ in encode(iter(texts)):
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--input-path", type=str) # Path to the corpus.jsonl of BEIR dataset
+    parser.add_argument("--limit", type=int, default=10000) # Number of documents to encode
+    parser.add_argument("--batch-size", type=int, default=4) # Arrival-order batch size
+    parser.add_argument("--max-batch-tokens", type=int, default=4096)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--window-size", type=int, default=1024)
+    parser.add_argument("--throughput", action="store_true") # Run the transformer, otherwise only padding is compared
+    args = parser.parse_args()
+
+    model_name = args.model_name or DEFAULT_MODEL_NAME
+    model = MiniCOIL(
+        vocab_path=os.path.join(DATA_DIR, f"{model_name}.vocab"),
+        word_encoder_path=os.path.join(DATA_DIR, f"{model_name}.npy"),
+        encoder_mode=Encoder.MODE_GROUPED,
+    )
+
+    texts = read_corpus(args.input_path, args.limit)
+    # The tokenizer pads to the longest document of the call, the attention mask tells the actual lengths
+    lengths = np.concatenate([
+        model.sentence_encoder.tokenize_batch(texts[start:start + args.window_size])[1].sum(axis=1)
+        for start in range(0, len(texts), args.window_size)
+    ])
+
+    total_tokens = int(lengths.sum())
+    print(f"Documents: {len(texts)}, tokens: {total_tokens}")
+    print(f"Length percentiles (50/90/99/max): {np.percentile(lengths, [50, 90, 99]).tolist()} / {lengths.max()}")
+
+    strategies = {
+        f"arrival order, batch_size={args.batch_size}": arrival_order_buckets(len(texts), args.batch_size),
+        f"bucketed, max_tokens={args.max_batch_tokens}": windowed_length_buckets(
+            lengths, args.max_batch_tokens, args.max_batch_size, args.window_size
+        ),
+    }
+    for name, buckets in strategies.items():
+        padded = padded_size(lengths, buckets)
+        print(f"{name}: {len(buckets)} batches, {padded} padded tokens, {1 - total_tokens / padded:.1%} padding")
+
+    if not args.throughput:
+        return
+
+    arrival_time = measure_time(lambda stream: model.encode_steam(stream, batch_size=args.batch_size), texts)
+    bucketed_time = measure_time(
+        lambda stream: model.encode_steam_bucketed(
+            stream,
+            max_tokens=args.max_batch_tokens,
+            max_batch_size=args.max_batch_size,
+            window_size=args.window_size
+        ),
+        texts
+    )
+    for name, elapsed in (("Arrival order", arrival_time), ("Bucketed", bucketed_time)):
+        print(
+            f"{name}: {len(texts) / elapsed:.1f} docs/sec, {total_tokens / elapsed:,.0f} tokens/sec "
+            f"({arrival_time / elapsed:.2f}x)"
+        )
+
+
+if __name__ == '__main__':
+    main()
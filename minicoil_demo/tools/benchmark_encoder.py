@@ -0,0 +1,147 @@
+"""
+Micro-benchmarks of the word encoder on random inputs, no model files required.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from minicoil_demo.model.encoder import Encoder
+
+
+def avg_by_vocab_ids_unique(vocab_ids: np.ndarray, embeddings: np.ndarray):
+    """
+    Reference pooling, based on `np.unique(axis=0)` and `np.add.at`.
+    """
+    input_dim = embeddings.shape[2]
+
+    flattened_vocab_ids = Encoder.convert_vocab_ids(vocab_ids).reshape(-1, 2)
+    flattened_embeddings = embeddings.reshape(-1, input_dim)
+
+    unique_flattened_vocab_ids, inverse_indices = np.unique(flattened_vocab_ids, axis=0, return_inverse=True)
+    inverse_indices = inverse_indices.reshape(-1)
+
+    unique_count = unique_flattened_vocab_ids.shape[0]
+    unique_flattened_embeddings = np.zeros((unique_count, input_dim), dtype=embeddings.dtype)
+    unique_flattened_count = np.zeros(unique_count, dtype=np.int32)
+
+    np.add.at(unique_flattened_embeddings, inverse_indices, flattened_embeddings)
+    np.add.at(unique_flattened_count, inverse_indices, 1)
+
+    unique_flattened_embeddings /= unique_flattened_count[:, None]
+
+    return unique_flattened_vocab_ids, unique_flattened_embeddings
+
+
+def random_batch(
+        rng: np.random.Generator,
+        batch_size: int,
+        seq_len: int,
+        vocab_size: int,
+        input_dim: int,
+        oov_ratio: float = 0.5
+):
+    # Zipfian vocab ids resemble real texts better than uniform ones
+    vocab_ids = rng.zipf(1.3, size=(batch_size, seq_len)) % vocab_size
+    vocab_ids[rng.random((batch_size, seq_len)) < oov_ratio] = 0
+    embeddings = rng.standard_normal((batch_size, seq_len, input_dim)).astype(np.float32)
+    return vocab_ids, embeddings
+
+
+def measure(func, repeats: int) -> float:
+    """
+    Returns best time of `repeats` runs, in milliseconds
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def benchmark_pooling(batch_sizes, seq_lens, vocab_size: int, input_dim: int, repeats: int):
+    rng = np.random.default_rng(42)
+
+    print(f"{'batch':>6} {'seq_len':>8} {'unique+add.at, ms':>18} {'segmented, ms':>14} {'speedup':>8}")
+
+    for batch_size in batch_sizes:
+        for seq_len in seq_lens:
+            vocab_ids, embeddings = random_batch(rng, batch_size, seq_len, vocab_size, input_dim)
+
+            expected_ids, expected_embeddings = avg_by_vocab_ids_unique(vocab_ids, embeddings)
+            actual_ids, actual_embeddings = Encoder.avg_by_vocab_ids(vocab_ids, embeddings)
+
+            # Groups are the same, sums may only differ by float rounding due to a different summation order
+            assert np.array_equal(expected_ids, actual_ids)
+            assert np.allclose(expected_embeddings, actual_embeddings, rtol=1e-5, atol=1e-6)
+
+            reference_time = measure(lambda: avg_by_vocab_ids_unique(vocab_ids, embeddings), repeats)
+            new_time = measure(lambda: Encoder.avg_by_vocab_ids(vocab_ids, embeddings), repeats)
+
+            print(
+                f"{batch_size:>6} {seq_len:>8} {reference_time:>18.2f} {new_time:>14.2f}"
+                f" {reference_time / new_time:>7.1f}x"
+            )
+
+
+def benchmark_linear(batch_sizes, seq_lens, vocab_size: int, input_dim: int, output_dim: int, repeats: int):
+    """
+    Compare per-word projection modes of the encoder on pooled embeddings of the whole batch
+    """
+    rng = np.random.default_rng(42)
+    weights = rng.standard_normal((vocab_size, input_dim, output_dim)).astype(np.float32)
+    encoder = Encoder(weights)
+
+    print(
+        f"{'batch':>6} {'seq_len':>8} {'rows':>7} {'words':>6} {'einsum, ms':>11} {'grouped, ms':>12} {'speedup':>8}"
+        f" {'gathered weights, MB':>21}"
+    )
+
+    for batch_size in batch_sizes:
+        for seq_len in seq_lens:
+            vocab_ids, embeddings = random_batch(rng, batch_size, seq_len, vocab_size, input_dim)
+            pooled_ids, pooled_embeddings = Encoder.avg_by_vocab_ids(vocab_ids, embeddings)
+            # Out-of-vocabulary words are not encoded
+            known = pooled_ids[:, 0] > 0
+            word_ids = pooled_ids[known, 0]
+            word_embeddings = pooled_embeddings[known]
+
+            expected = encoder.einsum_linear(word_ids, word_embeddings)
+            actual = encoder.grouped_linear(word_ids, word_embeddings)
+            assert np.allclose(expected, actual, rtol=1e-4, atol=1e-4)
+
+            einsum_time = measure(lambda: encoder.einsum_linear(word_ids, word_embeddings), repeats)
+            grouped_time = measure(lambda: encoder.grouped_linear(word_ids, word_embeddings), repeats)
+
+            num_words = len(np.unique(word_ids))
+            # Einsum gathers a copy of weights for every (word, document) pair
+            gathered_mb = len(word_ids) * input_dim * output_dim * weights.itemsize / 2 ** 20
+
+            print(
+                f"{batch_size:>6} {seq_len:>8} {len(word_ids):>7} {num_words:>6} {einsum_time:>11.2f} {grouped_time:>12.2f}"
+                f" {einsum_time / grouped_time:>7.1f}x {gathered_mb:>21.1f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", type=str, default="pooling", choices=["pooling", "linear"])
+    parser.add_argument("--batch-sizes", type=int, nargs='+', default=None) # Defaults to 1..256 for pooling and 1..512 for linear
+    parser.add_argument("--seq-lens", type=int, nargs='+', default=[32, 128, 512])
+    parser.add_argument("--vocab-size", type=int, default=30000)
+    parser.add_argument("--input-dim", type=int, default=512)
+    parser.add_argument("--output-dim", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.benchmark == "pooling":
+        batch_sizes = args.batch_sizes or [1, 4, 16, 64, 256]
+        benchmark_pooling(batch_sizes, args.seq_lens, args.vocab_size, args.input_dim, args.repeats)
+    else:
+        batch_sizes = args.batch_sizes or [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+        benchmark_linear(batch_sizes, args.seq_lens, args.vocab_size, args.input_dim, args.output_dim, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
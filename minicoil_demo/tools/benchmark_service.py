@@ -0,0 +1,75 @@
+"""
+Load test of the running service: sends queries to `/api/embed` with the given concurrency
+and reports throughput and latency percentiles.
+
+Queries are made unique by default, so that the query cache doesn't hide the cost of inference.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+import numpy as np
+
+from minicoil_demo.tools.corpus import json_loads
+
+
+def read_texts(file_path: str, limit: int) -> list:
+    texts = []
+    with open(file_path, "rb") as f:
+        for line in f:
+            if len(texts) >= limit:
+                break
+            # Queries of BEIR datasets have no title
+            texts.append(json_loads(line)["text"])
+    return texts
+
+
+async def run_load(url: str, queries: list, concurrency: int) -> list:
+    latencies = []
+    pending = iter(queries)
+
+    async def worker(client: httpx.AsyncClient):
+        for query in pending:
+            start = time.perf_counter()
+            response = await client.get(url, params={"query": query})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://localhost:8000/api/embed")
+    parser.add_argument("--input-path", type=str) # corpus.jsonl or queries.jsonl of BEIR dataset
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--max-words", type=int, default=10) # Queries are cut to this many words
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument("--repeat-queries", action="store_true") # Don't make queries unique, measures the query cache
+    args = parser.parse_args()
+
+    texts = read_texts(args.input_path, args.num_queries)
+    queries = [" ".join(text.split()[:args.max_words]) for text in texts]
+    if not args.repeat_queries:
+        queries = [f"{query} {random.randint(0, 10 ** 9)}" for query in queries]
+
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        latencies = asyncio.run(run_load(args.url, queries, concurrency))
+        elapsed = time.perf_counter() - start
+
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        print(
+            f"concurrency {concurrency}: {len(latencies) / elapsed:.1f} queries/sec, "
+            f"p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Throughput of `VocabResolver.resolve_tokens` on a BEIR corpus, in tokens per second.
+
+Compares the lookup table based resolver against the reference per-token implementation
+and checks, that both produce the same output.
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from typing import List, Tuple
+
+import numpy as np
+from tokenizers import Tokenizer
+
+from minicoil_demo.config import DATA_DIR
+from minicoil_demo.model.stopwords import english_stopwords
+from minicoil_demo.model.vocab_resolver import VocabResolver, VocabTokenizerTokenizer
+
+DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
+
+
+def resolve_tokens_reference(resolver: VocabResolver, token_ids: np.ndarray) -> Tuple[np.ndarray, dict, dict, dict]:
+    """
+    Reference implementation: converts every token to string and resolves every word separately.
+    """
+    tokens = resolver.convert_ids_to_tokens(token_ids)
+    tokens_mapping = resolver._reconstruct_bpe(enumerate(tokens))
+
+    counts = defaultdict(int)
+    oov_count = defaultdict(int)
+
+    forms = defaultdict(list)
+
+    for token, mapped_token_ids in tokens_mapping:
+        vocab_id = 0
+        if token in english_stopwords:
+            vocab_id = 0
+        elif token in resolver.vocab:
+            vocab_id = resolver.vocab[token]
+            forms[token].append(token)
+        elif token in resolver.stem_mapping:
+            vocab_id = resolver.vocab[resolver.stem_mapping[token]]
+            forms[resolver.stem_mapping[token]].append(token)
+        else:
+            stem = resolver.stemmer.stem_word(token)
+            if stem in resolver.stem_mapping:
+                vocab_id = resolver.vocab[resolver.stem_mapping[stem]]
+                forms[resolver.stem_mapping[stem]].append(token)
+
+        for token_id in mapped_token_ids:
+            token_ids[token_id] = vocab_id
+
+        if vocab_id == 0:
+            oov_count[token] += 1
+        else:
+            counts[vocab_id] += 1
+
+    return token_ids, counts, oov_count, forms
+
+
+def read_corpus(file_path: str, limit: int) -> List[str]:
+    texts = []
+    with open(file_path, "r") as f:
+        for line in f:
+            if len(texts) >= limit:
+                break
+            data = json.loads(line)
+            texts.append(data["title"] + "\n" + data["text"])
+    return texts
+
+
+def load_tokenizer(tokenizer_path: str, sentence_encoder_model: str) -> Tokenizer:
+    if tokenizer_path is not None:
+        return Tokenizer.from_file(tokenizer_path)
+
+    from fastembed.late_interaction.token_embeddings import TokenEmbeddingsModel
+    return TokenEmbeddingsModel(model_name=sentence_encoder_model, threads=1).tokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--input-path", type=str) # Path to the corpus.jsonl of BEIR dataset
+    parser.add_argument("--limit", type=int, default=10000) # Number of documents to resolve
+    parser.add_argument("--tokenizer-path", type=str, default=None) # tokenizer.json, loaded from the sentence encoder if not provided
+    parser.add_argument("--sentence-encoder-model", type=str, default="jinaai/jina-embeddings-v2-small-en-tokens")
+    args = parser.parse_args()
+
+    model_name = args.model_name or DEFAULT_MODEL_NAME
+    vocab_path = os.path.join(DATA_DIR, f"{model_name}.vocab")
+
+    tokenizer = load_tokenizer(args.tokenizer_path, args.sentence_encoder_model)
+    resolver = VocabResolver(tokenizer=VocabTokenizerTokenizer(tokenizer))
+    resolver.load_json_vocab(vocab_path)
+
+    texts = read_corpus(args.input_path, args.limit)
+    token_ids = [np.array(encoding.ids) for encoding in tokenizer.encode_batch(texts)]
+    total_tokens = sum(len(ids) for ids in token_ids)
+
+    start = time.perf_counter()
+    expected = [resolve_tokens_reference(resolver, ids.copy()) for ids in token_ids]
+    reference_time = time.perf_counter() - start
+
+    # Lookup tables are built once per resolver, measure them separately
+    start = time.perf_counter()
+    resolver.build_token_tables()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [resolver.resolve_tokens(ids.copy()) for ids in token_ids]
+    new_time = time.perf_counter() - start
+
+    for expected_result, actual_result in zip(expected, actual):
+        assert np.array_equal(expected_result[0], actual_result[0])
+        for expected_mapping, actual_mapping in zip(expected_result[1:], actual_result[1:]):
+            assert dict(expected_mapping) == dict(actual_mapping)
+
+    print(f"Documents: {len(texts)}, tokens: {total_tokens}")
+    print(f"Lookup tables built in {build_time * 1000:.1f} ms")
+    print(f"Reference: {total_tokens / reference_time:,.0f} tokens/sec")
+    print(f"Lookup tables: {total_tokens / new_time:,.0f} tokens/sec ({reference_time / new_time:.1f}x)")
+    print(f"Composed words cache: {resolver.word_cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
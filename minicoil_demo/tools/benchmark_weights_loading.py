@@ -0,0 +1,110 @@
+"""
+Startup time and memory usage of N processes, each loading word encoder weights,
+the same way `uvicorn --workers N` or ingestion workers do.
+
+Compares full `np.load` against memory-mapped weights. Memory numbers are read from /proc, so Linux only.
+PSS (proportional set size) splits shared pages between processes, so total PSS is the real memory footprint.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from minicoil_demo.model.encoder import Encoder
+
+
+def read_memory_kb() -> dict:
+    memory = {}
+    with open("/proc/self/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:"):
+                memory[parts[0][:-1].lower()] = int(parts[1])
+    return memory
+
+
+def worker(weights_path: str, mmap_weights: bool, batch_size: int, seq_len: int, barrier, results):
+    start = time.perf_counter()
+    weights = np.load(weights_path, mmap_mode="r" if mmap_weights else None)
+    encoder = Encoder(weights, mode=Encoder.MODE_GROUPED)
+    load_time = time.perf_counter() - start
+
+    # Encode a batch, so that memory-mapped weights of some words are actually paged in
+    rng = np.random.default_rng(os.getpid())
+    vocab_ids = rng.zipf(1.3, size=(batch_size, seq_len)) % encoder.vocab_size
+    embeddings = rng.standard_normal((batch_size, seq_len, encoder.input_dim)).astype(np.float32)
+
+    start = time.perf_counter()
+    encoder.forward(vocab_ids, embeddings)
+    forward_time = time.perf_counter() - start
+
+    # Measure when all workers are alive, so that shared pages are split between them
+    barrier.wait()
+    results.put({"load_time": load_time, "forward_time": forward_time, **read_memory_kb()})
+    barrier.wait()
+
+
+def run(weights_path: str, workers: int, mmap_weights: bool, batch_size: int, seq_len: int) -> list:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+
+    processes = [
+        context.Process(target=worker, args=(weights_path, mmap_weights, batch_size, seq_len, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    stats = [results.get() for _ in range(workers)]
+
+    for process in processes:
+        process.join()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights-path", type=str, default=None) # Random weights are generated if not provided
+    parser.add_argument("--vocab-size", type=int, default=30000)
+    parser.add_argument("--input-dim", type=int, default=512)
+    parser.add_argument("--output-dim", type=int, default=4)
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=256)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        weights_path = args.weights_path
+        if weights_path is None:
+            weights_path = os.path.join(tmp_dir, "weights.npy")
+            weights = np.random.default_rng(42).standard_normal(
+                (args.vocab_size, args.input_dim, args.output_dim)
+            ).astype(np.float32)
+            np.save(weights_path, weights)
+            del weights
+
+        print(f"Weights file size: {os.path.getsize(weights_path) / 2 ** 20:.1f} MiB")
+        print(
+            f"{'workers':>8} {'mmap':>5} {'load, ms (max)':>15} {'forward, ms (max)':>18}"
+            f" {'RSS, MiB (sum)':>15} {'PSS, MiB (sum)':>15}"
+        )
+
+        for workers in args.workers:
+            for mmap_weights in (False, True):
+                stats = run(weights_path, workers, mmap_weights, args.batch_size, args.seq_len)
+                print(
+                    f"{workers:>8} {str(mmap_weights):>5}"
+                    f" {max(s['load_time'] for s in stats) * 1000:>15.1f}"
+                    f" {max(s['forward_time'] for s in stats) * 1000:>18.1f}"
+                    f" {sum(s['rss'] for s in stats) / 1024:>15.1f}"
+                    f" {sum(s['pss'] for s in stats) / 1024:>15.1f}"
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Throughput of the ingestion encoding on a BEIR corpus, in tokens and documents per second,
+with the whole pipeline in the main process and in 1..N worker processes, see `parallel_encoding.py`.
+
+Timings of worker runs include starting the pool and loading a model in every worker,
+use a `--limit` large enough for that to be amortized, as in a real ingestion.
+Vectors of every run are checked against the first one.
+"""
+import argparse
+import os
+import time
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+from minicoil_demo.config import DATA_DIR
+from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.model.sparse_vector import SparseVectorConverter
+from minicoil_demo.tools.benchmark_vocab_resolver import read_corpus
+from minicoil_demo.tools.parallel_encoding import EncodingConfig, parallel_sparse_vectors
+
+DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
+
+
+def in_process_vectors(model: MiniCOIL, converter: SparseVectorConverter, texts: List[str], batch_size: int) -> Iterable[Tuple[list, list]]:
+    for embedding in model.encode_steam(texts, batch_size=batch_size):
+        indices, values = converter.sentence_embedding_to_arrays(model, embedding)
+        yield indices.tolist(), values.tolist()
+
+
+def worker_vectors(config: EncodingConfig, texts: List[str], workers: int, chunk_size: int) -> Iterable[Tuple[list, list]]:
+    for encoded in parallel_sparse_vectors(config, texts, workers=workers, chunk_size=chunk_size):
+        yield encoded.vector.indices, encoded.vector.values
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--input-path", type=str) # Path to the corpus.jsonl of BEIR dataset
+    parser.add_argument("--limit", type=int, default=10000) # Number of documents to encode
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 1, 2, 4]) # 0 - whole pipeline in the main process
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=256)
+    args = parser.parse_args()
+
+    model_name = args.model_name or DEFAULT_MODEL_NAME
+    model = MiniCOIL(
+        vocab_path=os.path.join(DATA_DIR, f"{model_name}.vocab"),
+        word_encoder_path=os.path.join(DATA_DIR, f"{model_name}.npy"),
+        mmap_weights=True,
+    )
+    converter = SparseVectorConverter()
+    config = EncodingConfig.from_model(model, batch_size=args.batch_size)
+
+    texts = read_corpus(args.input_path, args.limit)
+    total_tokens = sum(
+        int(model.sentence_encoder.tokenize_batch(texts[start:start + 1024])[1].sum())
+        for start in range(0, len(texts), 1024)
+    )
+    print(f"Documents: {len(texts)}, tokens: {total_tokens}, CPUs: {os.cpu_count()}")
+
+    expected = None
+    baseline_speed = None
+    for workers in args.workers:
+        start = time.perf_counter()
+        if workers == 0:
+            vectors = list(in_process_vectors(model, converter, texts, args.batch_size))
+        else:
+            vectors = list(worker_vectors(config, texts, workers, args.chunk_size))
+        elapsed = time.perf_counter() - start
+
+        if expected is None:
+            expected = vectors
+        else:
+            for (expected_indices, expected_values), (indices, values) in zip(expected, vectors):
+                assert expected_indices == indices
+                # Workers pass values as float32
+                assert np.allclose(expected_values, values, rtol=1e-5, atol=1e-6)
+
+        tokens_speed = total_tokens / elapsed
+        baseline_speed = baseline_speed or tokens_speed
+        name = "in-process" if workers == 0 else f"{workers} workers"
+        print(
+            f"{name}: {tokens_speed:,.0f} tokens/sec, {len(texts) / elapsed:.1f} docs/sec "
+            f"({tokens_speed / baseline_speed:.2f}x)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Checkpoints of corpus ingestion, so that an interrupted run is resumed from the last uploaded document.
+
+A checkpoint is written after every batch acknowledged by Qdrant and contains the byte offset in the corpus
+right after the last document, which is guaranteed to be uploaded along with all documents before it.
+Resuming seeks directly to that offset, skipped documents are not read at all.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional
+
+from minicoil_demo.tools.upload_pipeline import UploadBatch
+
+
+@dataclass
+class Checkpoint:
+    corpus_path: str
+    collection_name: str
+    # Byte offset in the corpus, where the first not uploaded document starts
+    offset: int = 0
+    # Point id of the first not uploaded document, point ids are line numbers in the corpus
+    next_idx: int = 0
+    # Average document length, used for BM25 of all uploaded documents
+    avg_len: Optional[float] = None
+
+    @classmethod
+    def load(cls, path: str) -> Optional["Checkpoint"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str):
+        """
+        Write atomically, so that a crash while saving leaves the previous checkpoint intact
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def validate(self, corpus_path: str, collection_name: str):
+        if os.path.abspath(self.corpus_path) != os.path.abspath(corpus_path):
+            raise ValueError(f"Checkpoint was created for corpus {self.corpus_path}, not {corpus_path}")
+        if self.collection_name != collection_name:
+            raise ValueError(f"Checkpoint was created for collection {self.collection_name}, not {collection_name}")
+
+
+class CheckpointTracker:
+    """
+    Advances the checkpoint as batches are acknowledged.
+
+    Batches of `UploadPipeline` contain consecutive documents, but might be acknowledged out of order,
+    so the checkpoint only moves past a batch once all batches before it are acknowledged as well.
+    """
+
+    def __init__(self, checkpoint: Checkpoint, path: str):
+        self.checkpoint = checkpoint
+        self.path = path
+
+        # End offsets of documents, which are read but not yet uploaded: point id -> byte offset after the document
+        self.offsets: Dict[int, int] = OrderedDict()
+        # Acknowledged batches, which can't be committed yet: batch seq -> last point id
+        self.acknowledged: Dict[int, int] = {}
+        self.next_seq = 0
+        # Reader and uploaders run in different threads
+        self.lock = threading.Lock()
+
+    def on_record(self, idx: int, end_offset: int):
+        """
+        Called by the corpus reader for every document
+        """
+        with self.lock:
+            self.offsets[idx] = end_offset
+
+    def on_batch_uploaded(self, batch: UploadBatch):
+        with self.lock:
+            self._commit(batch)
+
+    def _commit(self, batch: UploadBatch):
+        self.acknowledged[batch.seq] = batch.points[-1].id
+
+        last_idx = None
+        while self.next_seq in self.acknowledged:
+            last_idx = self.acknowledged.pop(self.next_seq)
+            self.next_seq += 1
+
+        if last_idx is None:
+            return
+
+        self.checkpoint.offset = self.offsets[last_idx]
+        self.checkpoint.next_idx = last_idx + 1
+        self.checkpoint.save(self.path)
+
+        while self.offsets:
+            idx = next(iter(self.offsets))
+            if idx > last_idx:
+                break
+            del self.offsets[idx]
+
+
+def test_checkpoint_tracker():
+    import tempfile
+    from qdrant_client import models
+
+    def make_batch(seq: int, ids: range) -> UploadBatch:
+        return UploadBatch(seq=seq, points=[models.PointStruct(id=idx, vector={}) for idx in ids])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "checkpoint.json")
+        tracker = CheckpointTracker(Checkpoint(corpus_path="corpus.jsonl", collection_name="test"), path)
+
+        for idx in range(10):
+            tracker.on_record(idx, (idx + 1) * 100)
+
+        tracker.on_batch_uploaded(make_batch(1, range(3, 6)))
+        assert Checkpoint.load(path) is None
+
+        tracker.on_batch_uploaded(make_batch(0, range(0, 3)))
+        checkpoint = Checkpoint.load(path)
+        assert checkpoint.offset == 600
+        assert checkpoint.next_idx == 6
+        assert list(tracker.offsets) == [6, 7, 8, 9]
+
+        tracker.on_batch_uploaded(make_batch(2, range(6, 9)))
+        assert Checkpoint.load(path).next_idx == 9
@@ -1,5 +1,6 @@
 import math
-import json
+
+from minicoil_demo.tools.corpus import Corpus
 
 
 def calculate_avg_length(file_path: str) -> float:
@@ -9,14 +10,9 @@ def calculate_avg_length(file_path: str) -> float:
     max_docs = 50_000
 
     if file_path.endswith(".json") or file_path.endswith(".jsonl"):
-        with open(file_path, "r") as f:
-            for line in f:
-                data = json.loads(line)
-                text = data['title'] + '\n' + data["text"]
-                total_texts_length += len(text.strip().split()) 
-                total_texts += 1
-
-                if total_texts >= max_docs:
-                    break
+        # Only the first documents are read, without building the offsets index
+        for document in Corpus(file_path).read(stop=max_docs):
+            total_texts_length += len(document.full_text.strip().split())
+            total_texts += 1
 
     return float(math.ceil(total_texts_length / total_texts))
\ No newline at end of file
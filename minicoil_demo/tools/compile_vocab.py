@@ -0,0 +1,86 @@
+"""
+Compile a JSON `.vocab` file into the memory-mapped format of `minicoil_demo.model.compiled_vocab`.
+
+By default the output is written next to the input as `<model>.vocab.bin`, where `MiniCOIL` picks it up
+instead of the JSON file, as long as it is not older than the JSON file, see `read_vocab`.
+
+With `--report`, the compiled vocab is checked against the JSON one word by word,
+and the time to load both and to look words up is printed.
+"""
+import argparse
+import os
+import time
+
+from minicoil_demo.config import DATA_DIR
+from minicoil_demo.model.compiled_vocab import CompiledVocab, write_compiled_vocab
+from minicoil_demo.model.vocab_resolver import compiled_vocab_path, read_json_vocab
+
+DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
+
+
+def compile_vocab(input_path: str, output_path: str) -> dict:
+    data = read_json_vocab(input_path)
+    write_compiled_vocab(output_path, data["vocab"], data["stem_mapping"])
+    return data
+
+
+def report(input_path: str, output_path: str, data: dict):
+    start = time.perf_counter()
+    words = read_json_vocab(input_path)["vocab"]
+    vocab = {word: idx + 1 for idx, word in enumerate(words)}
+    json_load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = CompiledVocab(output_path)
+    compiled_load_time = time.perf_counter() - start
+
+    for idx, word in enumerate(data["vocab"]):
+        assert compiled.vocab[word] == idx + 1, word
+        assert compiled.words[idx] == word, word
+    for stem, word in data["stem_mapping"].items():
+        assert compiled.stem_mapping[stem] == word, stem
+
+    # Half of lookups are misses, as for out-of-vocabulary words
+    queries = data["vocab"] + [word + "#" for word in data["vocab"]]
+
+    start = time.perf_counter()
+    for word in queries:
+        vocab.get(word)
+    dict_lookup_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for word in queries:
+        compiled.vocab.get(word)
+    compiled_lookup_time = time.perf_counter() - start
+
+    print(f"Load: JSON {json_load_time * 1000:.1f} ms, compiled {compiled_load_time * 1000:.3f} ms")
+    print(
+        f"Lookup: dict {dict_lookup_time / len(queries) * 1e9:.0f} ns, "
+        f"compiled {compiled_lookup_time / len(queries) * 1e9:.0f} ns per word"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-name", type=str, default=None)
+    parser.add_argument("--input-path", type=str, default=None) # Path to the JSON vocab, defaults to <model-name>.vocab in the data dir
+    parser.add_argument("--output-path", type=str, default=None) # Defaults to <input-path>.bin
+    parser.add_argument("--report", action="store_true")
+    args = parser.parse_args()
+
+    model_name = args.model_name or DEFAULT_MODEL_NAME
+    input_path = args.input_path or os.path.join(DATA_DIR, f"{model_name}.vocab")
+    output_path = args.output_path or compiled_vocab_path(input_path)
+
+    data = compile_vocab(input_path, output_path)
+    print(
+        f"Compiled {len(data['vocab'])} words and {len(data['stem_mapping'])} stems into {output_path}: "
+        f"{os.path.getsize(output_path)} bytes, JSON is {os.path.getsize(input_path)} bytes"
+    )
+
+    if args.report:
+        report(input_path, output_path, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""
+Convert word encoder weights into a layout, which can be memory-mapped with `MiniCOIL(mmap_weights=True)`,
+optionally reducing their precision.
+
+The output is a plain `.npy` file with a C-contiguous little-endian tensor of shape
+(vocab_size, input_dim, output_dim), so weights of every word occupy a single contiguous block of the file
+and only pages of words, which are actually used, are read from disk.
+
+Supported precisions:
+    - float32: original weights
+    - float16: half the size, converted back to float32 on the fly
+    - int8: a quarter of the size, symmetric per-word quantization.
+        Per-word scales are stored next to the weights, see `minicoil_demo.model.encoder.scales_path`
+
+With `--report`, outputs of the converted weights are compared with the original ones on random inputs.
+With `--eval-dataset`, retrieval quality is compared on a BEIR dataset: documents and queries are encoded
+with both weights and searched in memory, with the same IDF weighting as Qdrant's `Modifier.IDF`.
+The transformer runs once per batch, only word encoders differ. Reported are NDCG@10 of both,
+and how close the converted weights are to the original ones: cosine similarity of document vectors
+and overlap of top-10 results.
+
+Full-scale numbers are obtained by indexing a dataset with `tools/encode_to_qdrant.py --word-encoder-path <converted>`
+and running `evaluation/evaluate.py --word-encoder-path <converted>` against it.
+"""
+import argparse
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from fastembed.common.utils import iter_batch
+
+from minicoil_demo.config import DATA_DIR
+from minicoil_demo.model.encoder import Encoder, scales_path
+from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.model.sparse_vector import SparseVectorConverter
+from minicoil_demo.tools.corpus import Corpus, Document
+from minicoil_demo.tools.corpus_stats import estimate_avg_length
+
+DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
+
+DTYPES = ("float32", "float16", "int8")
+
+
+def quantize_int8(weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-word quantization: the largest absolute weight of each word is mapped to 127.
+
+    Returns:
+        quantized: (vocab_size, input_dim, output_dim) int8 array
+        scales: (vocab_size) float32 array
+    """
+    max_abs = np.abs(weights).reshape(weights.shape[0], -1).max(axis=1)
+    scales = (max_abs / 127).astype(np.float32)
+    # Unused words might have all-zero weights
+    scales[scales == 0] = 1.0
+
+    quantized = np.clip(np.round(weights / scales[:, None, None]), -127, 127).astype(np.int8)
+    return quantized, scales
+
+
+def dequantize(weights: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+    weights = weights.astype(np.float32)
+    if scales is not None:
+        weights *= scales[:, None, None]
+    return weights
+
+
+def convert_weights(input_path: str, output_path: str, dtype: str = "float32") -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    weights = np.load(input_path, mmap_mode="r")
+
+    if weights.ndim != 3:
+        raise ValueError(f"Expected weights of shape (vocab_size, input_dim, output_dim), got {weights.shape}")
+
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype: {dtype}, expected one of {DTYPES}")
+
+    scales = None
+    if dtype == "int8":
+        weights, scales = quantize_int8(np.asarray(weights, dtype=np.float32))
+        np.save(scales_path(output_path), np.ascontiguousarray(scales, dtype=np.dtype("<f4")))
+    else:
+        weights = np.ascontiguousarray(weights, dtype=np.dtype(dtype).newbyteorder("<"))
+
+    np.save(output_path, weights)
+
+    return weights, scales
+
+
+def accuracy_report(original: np.ndarray, converted: np.ndarray, scales: Optional[np.ndarray], sample_size: int = 10000):
+    """
+    Compare outputs of the original and converted weights on random token embeddings.
+    The cosine similarity matters the most, since word embeddings are normalized in sparse vectors.
+    """
+    rng = np.random.default_rng(42)
+    vocab_size, input_dim, output_dim = original.shape
+
+    word_ids = rng.integers(1, vocab_size, size=sample_size)
+    embeddings = rng.standard_normal((sample_size, input_dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    original_weights = np.asarray(original[word_ids], dtype=np.float32)
+    converted_weights = dequantize(converted[word_ids], None if scales is None else scales[word_ids])
+
+    expected = np.tanh(np.einsum('bi,bio->bo', embeddings, original_weights))
+    actual = np.tanh(np.einsum('bi,bio->bo', embeddings, converted_weights))
+
+    weights_error = np.linalg.norm(original_weights - converted_weights) / np.linalg.norm(original_weights)
+    cosine = np.sum(expected * actual, axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+
+    print(f"Relative weights error: {weights_error:.6f}")
+    print(f"Max absolute output error: {np.abs(expected - actual).max():.6f}")
+    print(f"Output cosine similarity: mean={cosine.mean():.6f}, min={cosine.min():.6f}")
+
+
+SparseArrays = Tuple[np.ndarray, np.ndarray]
+
+
+def read_beir_dataset(
+        dataset_dir: str,
+        split: str = "test",
+        max_documents: Optional[int] = None
+) -> Tuple[List[Document], Dict[str, str], Dict[str, Dict[str, int]]]:
+    """
+    Documents, queries and relevance judgements of a BEIR dataset, as downloaded by `tools/download_beir_dataset.py`.
+    With `max_documents`, judgements are restricted to the documents read, and queries left without any are dropped.
+    """
+    from minicoil_demo.evaluation.evaluate import load_qrels
+
+    documents = list(Corpus(os.path.join(dataset_dir, "corpus.jsonl")).read(stop=max_documents))
+    doc_ids = {document.doc_id for document in documents}
+
+    qrels = {}
+    for query_id, judgements in load_qrels(os.path.join(dataset_dir, "qrels", f"{split}.tsv")).items():
+        judgements = {doc_id: score for doc_id, score in judgements.items() if doc_id in doc_ids}
+        if judgements:
+            qrels[query_id] = judgements
+
+    queries = {}
+    with open(os.path.join(dataset_dir, "queries.jsonl"), "r") as f:
+        for line in f:
+            row = json.loads(line)
+            if row["_id"] in qrels:
+                queries[row["_id"]] = row["text"]
+
+    return documents, queries, qrels
+
+
+def load_encoders(model: MiniCOIL, weight_paths: Dict[str, str]) -> Dict[str, Encoder]:
+    encoders = {}
+    for name, path in weight_paths.items():
+        model.word_encoder_path = path
+        model.load_encoder_numpy()
+        encoders[name] = model.word_encoder
+    return encoders
+
+
+def encode_with_encoders(
+        model: MiniCOIL,
+        encoders: Dict[str, Encoder],
+        converter: SparseVectorConverter,
+        texts: List[str],
+        query: bool,
+        batch_size: int = 32
+) -> Dict[str, List[SparseArrays]]:
+    """
+    Sparse vectors of texts with each of the word encoders, the transformer runs once per batch
+    """
+    vectors = {name: [] for name in encoders}
+    for batch in iter_batch(texts, batch_size):
+        token_ids, attention_mask = model.sentence_encoder.tokenize_batch(batch)
+        output = model.sentence_encoder.embed_tokens(token_ids, attention_mask)
+        for name, encoder in encoders.items():
+            model.word_encoder = encoder
+            for embedding in model.encode_batch(output.input_ids, output.attention_mask, output.model_output):
+                vectors[name].append(converter.sentence_embedding_to_arrays(model, embedding, query=query))
+    return vectors
+
+
+class InMemorySparseIndex:
+    """
+    Brute-force search over sparse vectors with IDF applied to each index, same as `Modifier.IDF` of Qdrant
+    """
+
+    def __init__(self, vectors: List[SparseArrays]):
+        self.num_documents = len(vectors)
+
+        sizes = [len(indices) for indices, _ in vectors]
+        doc_rows = np.repeat(np.arange(len(vectors)), sizes)
+        indices = np.concatenate([vector_indices for vector_indices, _ in vectors]).astype(np.int64)
+        values = np.concatenate([vector_values for _, vector_values in vectors]).astype(np.float64)
+
+        # Postings of each index are contiguous
+        order = np.argsort(indices, kind="stable")
+        self.indices, self.starts, document_frequencies = np.unique(indices[order], return_index=True, return_counts=True)
+        self.ends = self.starts + document_frequencies
+        self.doc_rows = doc_rows[order]
+        self.values = values[order]
+
+        idf = np.log(1 + (self.num_documents - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        self.values *= np.repeat(idf, document_frequencies)
+
+    def search(self, query: SparseArrays, limit: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            rows of the top documents and their scores, best first
+        """
+        query_indices, query_values = query
+        scores = np.zeros(self.num_documents, dtype=np.float64)
+
+        positions = np.searchsorted(self.indices, query_indices)
+        for position, index, value in zip(positions.tolist(), query_indices.tolist(), query_values.tolist()):
+            if position >= len(self.indices) or self.indices[position] != index:
+                continue
+            start, end = self.starts[position], self.ends[position]
+            np.add.at(scores, self.doc_rows[start:end], self.values[start:end] * value)
+
+        limit = min(limit, self.num_documents)
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        top = top[scores[top] > 0]
+        return top, scores[top]
+
+
+def retrieval_report(
+        model: MiniCOIL,
+        weight_paths: Dict[str, str],
+        dataset_dir: str,
+        split: str = "test",
+        max_documents: Optional[int] = None,
+        batch_size: int = 32,
+        limit: int = 10
+):
+    """
+    Compare retrieval quality of weights on a BEIR dataset, the first of `weight_paths` is the reference.
+    """
+    from ranx import Qrels, Run, evaluate
+
+    documents, queries, qrels = read_beir_dataset(dataset_dir, split, max_documents)
+    query_ids = list(queries)
+    print(f"Dataset: {len(documents)} documents, {len(query_ids)} queries")
+
+    avg_len = estimate_avg_length(model, SparseVectorConverter(), documents)
+    converter = SparseVectorConverter(avg_len=avg_len)
+
+    encoders = load_encoders(model, weight_paths)
+    document_vectors = encode_with_encoders(model, encoders, converter, [document.full_text for document in documents], query=False, batch_size=batch_size)
+    query_vectors = encode_with_encoders(model, encoders, converter, [queries[query_id] for query_id in query_ids], query=True, batch_size=batch_size)
+
+    reference_name = next(iter(weight_paths))
+    results = {}
+    for name in weight_paths:
+        index = InMemorySparseIndex(document_vectors[name])
+        results[name] = [index.search(query, limit) for query in query_vectors[name]]
+
+    reference_ndcg = None
+    for name in weight_paths:
+        run = Run({
+            query_id: {documents[row].doc_id: float(score) for row, score in zip(rows.tolist(), scores.tolist())}
+            for query_id, (rows, scores) in zip(query_ids, results[name])
+        })
+        ndcg = evaluate(Qrels(qrels), run, f"ndcg@{limit}")
+        reference_ndcg = ndcg if reference_ndcg is None else reference_ndcg
+
+        line = f"{name}: NDCG@{limit} {ndcg:.4f} ({ndcg - reference_ndcg:+.4f})"
+        if name != reference_name:
+            # Same words produce the same indices, only values differ
+            cosines = [
+                np.dot(expected_values, values) / (np.linalg.norm(expected_values) * np.linalg.norm(values))
+                for (_, expected_values), (_, values) in zip(document_vectors[reference_name], document_vectors[name])
+                if len(values) > 0
+            ]
+            overlaps = [
+                len(set(expected_rows.tolist()) & set(rows.tolist())) / max(len(expected_rows), 1)
+                for (expected_rows, _), (rows, _) in zip(results[reference_name], results[name])
+            ]
+            line += (
+                f", document vector cosine: mean {np.mean(cosines):.6f}, min {np.min(cosines):.6f}"
+                f", top-{limit} overlap: {np.mean(overlaps):.4f}"
+            )
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-path", type=str) # Path to the minicoil.model.npy
+    parser.add_argument("--output-path", type=str)
+    parser.add_argument("--dtype", type=str, default="float32", choices=DTYPES)
+    parser.add_argument("--report", action="store_true")
+    parser.add_argument("--eval-dataset", type=str, default=None) # Directory of a BEIR dataset, e.g. data/scifact
+    parser.add_argument("--eval-split", type=str, default="test")
+    parser.add_argument("--eval-max-documents", type=int, default=None) # Evaluate on the first documents of the corpus only
+    parser.add_argument("--model-name", type=str, default=None) # Vocab of the model is used with --eval-dataset
+    parser.add_argument("--sentence-encoder-model", type=str, default="jinaai/jina-embeddings-v2-small-en-tokens")
+    args = parser.parse_args()
+
+    weights, scales = convert_weights(args.input_path, args.output_path, dtype=args.dtype)
+
+    vocab_size, input_dim, output_dim = weights.shape
+    print(f"Converted weights: vocab_size={vocab_size}, input_dim={input_dim}, output_dim={output_dim}, dtype={args.dtype}")
+    print(f"Size per word: {input_dim * output_dim * weights.itemsize} bytes, total: {weights.nbytes} bytes")
+
+    if args.report:
+        accuracy_report(np.load(args.input_path, mmap_mode="r"), weights, scales)
+
+    if args.eval_dataset is not None:
+        model_name = args.model_name or DEFAULT_MODEL_NAME
+        model = MiniCOIL(
+            vocab_path=os.path.join(DATA_DIR, f"{model_name}.vocab"),
+            word_encoder_path=args.input_path,
+            sentence_encoder_model=args.sentence_encoder_model,
+            threads=None
+        )
+        retrieval_report(
+            model,
+            {"original": args.input_path, args.dtype: args.output_path},
+            args.eval_dataset,
+            split=args.eval_split,
+            max_documents=args.eval_max_documents
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Reader of BEIR `corpus.jsonl` files.
+
+The first time a corpus is read by document number, an index of line offsets is built with a single
+vectorized scan and saved next to the corpus as `<corpus>.offsets.npy`, so any range of documents
+can be read without scanning the lines before it. This allows resuming and splitting the corpus into shards
+for parallel workers.
+
+Lines are decoded with `orjson` if it is installed, which is several times faster than `json`.
+"""
+import json
+import os
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Size of blocks, in which the corpus is scanned for line breaks
+SCAN_BLOCK_SIZE = 16 * 2 ** 20
+
+
+class Document(NamedTuple):
+    # Line number in the corpus, used as point id
+    idx: int
+    doc_id: str
+    title: str
+    text: str
+
+    @property
+    def full_text(self) -> str:
+        # https://github.com/castorini/anserini/blob/4de1d53629507eb9051300a38d46cbc460b4e7d9/src/main/java/io/anserini/collection/BeirFlatCollection.java#L77
+        return self.title + '\n' + self.text
+
+
+def index_path(corpus_path: str) -> str:
+    return corpus_path + ".offsets.npy"
+
+
+def build_offsets(corpus_path: str) -> np.ndarray:
+    """
+    Offsets of line starts, with the file size at the end: line `i` occupies [offsets[i], offsets[i + 1])
+    """
+    line_ends = []
+    position = 0
+    last_byte = b"\n"
+    with open(corpus_path, "rb") as f:
+        while True:
+            block = f.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            line_ends.append(newlines + position + 1)
+            position += len(block)
+            last_byte = block[-1:]
+
+    # Last line might have no trailing line break
+    if last_byte != b"\n":
+        line_ends.append(np.array([position], dtype=np.int64))
+
+    return np.concatenate([np.zeros(1, dtype=np.int64)] + line_ends).astype(np.int64)
+
+
+class Corpus:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offsets: Optional[np.ndarray] = None
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """
+        Offsets index, loaded from disk if it is up to date with the corpus, built otherwise
+        """
+        if self._offsets is None:
+            self._offsets = self._load_offsets()
+        return self._offsets
+
+    def _load_offsets(self) -> np.ndarray:
+        cached_path = index_path(self.path)
+        corpus_size = os.path.getsize(self.path)
+
+        if os.path.exists(cached_path) and os.path.getmtime(cached_path) >= os.path.getmtime(self.path):
+            offsets = np.load(cached_path)
+            if offsets[-1] == corpus_size:
+                return offsets
+
+        offsets = build_offsets(self.path)
+        try:
+            np.save(cached_path, offsets)
+        except OSError:
+            # Read-only location, the index is rebuilt next time
+            pass
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def shard(self, shard_id: int, num_shards: int) -> Tuple[int, int]:
+        """
+        Range of documents [start, stop) of the given shard, shards are contiguous and of equal size
+        """
+        bounds = np.linspace(0, len(self), num_shards + 1).astype(np.int64)
+        return int(bounds[shard_id]), int(bounds[shard_id + 1])
+
+    def read(
+            self,
+            start: int = 0,
+            stop: Optional[int] = None,
+            start_offset: Optional[int] = None,
+            on_record: Optional[Callable[[int, int], None]] = None
+    ) -> Iterator[Document]:
+        """
+        Read documents [start, stop).
+
+        Args:
+            start: number of the first document
+            stop: number of the document to stop at, read until the end of the corpus if None
+            start_offset: byte offset of the `start` document, if known. Otherwise it is taken from the index
+            on_record: called with the document number and the byte offset right after it, for every document
+        """
+        if start_offset is None:
+            start_offset = int(self.offsets[start]) if start > 0 else 0
+
+        with open(self.path, "rb") as f:
+            f.seek(start_offset)
+            offset = start_offset
+            for idx, line in enumerate(f, start=start):
+                if stop is not None and idx >= stop:
+                    break
+                offset += len(line)
+                data = json_loads(line)
+                if on_record is not None:
+                    on_record(idx, offset)
+                yield Document(idx, data["_id"], data["title"], data["text"])
+
+
+def encode_documents(
+        documents: Iterable[Document],
+        encode: Callable[[Iterable[str]], Iterable]
+) -> Iterator[Tuple[Document, object]]:
+    """
+    Pair documents with results of `encode` applied to the stream of their texts, reading documents only once.
+
+    `encode` must produce exactly one result per text, in the same order. Documents are buffered only
+    while `encode` reads ahead of its output, e.g. within a batch.
+    """
+    pending = deque()
+
+    def texts() -> Iterator[str]:
+        for document in documents:
+            pending.append(document)
+            yield document.full_text
+
+    for result in encode(texts()):
+        yield pending.popleft(), result
+
+
+def test_corpus():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "corpus.jsonl")
+        with open(path, "w") as f:
+            for i in range(10):
+                f.write(json.dumps({"_id": f"doc{i}", "title": f"title {i}", "text": "naïve café " * i}, ensure_ascii=False))
+                if i < 9:
+                    # No line break after the last document
+                    f.write("\n")
+
+        corpus = Corpus(path)
+        assert len(corpus) == 10
+        assert os.path.exists(index_path(path))
+
+        documents = list(corpus.read())
+        assert [document.doc_id for document in documents] == [f"doc{i}" for i in range(10)]
+        assert documents[3].full_text == "title 3\n" + "naïve café " * 3
+
+        assert [document.idx for document in corpus.read(4, 7)] == [4, 5, 6]
+        assert list(Corpus(path).read(8)) == documents[8:]
+
+        offsets: List[Tuple[int, int]] = []
+        list(corpus.read(on_record=lambda idx, offset: offsets.append((idx, offset))))
+        assert [offset for _, offset in offsets] == corpus.offsets[1:].tolist()
+        assert list(corpus.read(5, start_offset=offsets[4][1])) == documents[5:]
+
+        assert [corpus.shard(i, 3) for i in range(3)] == [(0, 3), (3, 6), (6, 10)]
+
+        paired = list(encode_documents(corpus.read(), lambda texts: (len(text) for text in texts)))
+        assert [(document.idx, length) for document, length in paired] == [(i, len(documents[i].full_text)) for i in range(10)]
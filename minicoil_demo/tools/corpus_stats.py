@@ -0,0 +1,165 @@
+"""
+Corpus statistics for BM25 weighting of miniCOIL sparse vectors: number of documents and average document length.
+Document frequencies are not collected, IDF is applied by Qdrant (`Modifier.IDF` of the collection).
+
+Lengths are measured in the units of `SparseVectorConverter.bm25_tf`, i.e. known words plus cleaned
+out-of-vocabulary words, not whitespace-separated tokens.
+
+Statistics are collected as a by-product of ingestion, with no extra pass over the corpus,
+and saved next to the corpus as `<corpus>.<model>.stats.npz` to be reused by later runs.
+The very first run of a corpus has no statistics yet, so it still estimates the average length
+on a sample of the corpus before the ingestion, see `estimate_avg_length`.
+That sample is only tokenized, the transformer is not run on it.
+"""
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import numpy as np
+
+from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.model.sparse_vector import SparseVectorConverter
+from minicoil_demo.tools.corpus import Document
+
+
+def stats_path(corpus_path: str, model_name: str) -> str:
+    return f"{corpus_path}.{model_name}.stats.npz"
+
+
+@dataclass
+class CorpusStats:
+    num_documents: int
+    total_length: float
+    # Size and modification time of the corpus, stats are discarded if the corpus changes
+    corpus_size: int
+    corpus_mtime: float
+
+    @property
+    def avg_len(self) -> float:
+        return self.total_length / self.num_documents if self.num_documents > 0 else 0.0
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            num_documents=self.num_documents,
+            total_length=self.total_length,
+            corpus_size=self.corpus_size,
+            corpus_mtime=self.corpus_mtime,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, corpus_path: str) -> Optional["CorpusStats"]:
+        """
+        Load stats, if they exist and were collected for the current version of the corpus
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as data:
+            stats = cls(
+                num_documents=int(data["num_documents"]),
+                total_length=float(data["total_length"]),
+                corpus_size=int(data["corpus_size"]),
+                corpus_mtime=float(data["corpus_mtime"]),
+            )
+
+        corpus_stat = os.stat(corpus_path)
+        if stats.corpus_size != corpus_stat.st_size or stats.corpus_mtime != corpus_stat.st_mtime:
+            return None
+
+        return stats
+
+
+class CorpusStatsCollector:
+    """
+    Accumulates statistics of documents, in a single streaming pass.
+    """
+
+    def __init__(self):
+        self.num_documents = 0
+        self.total_length = 0.0
+
+    def add(self, length: float):
+        """
+        Args:
+            length: length of the document, see `SparseVectorConverter.document_length`
+        """
+        self.num_documents += 1
+        self.total_length += length
+
+    def stats(self, corpus_path: str) -> CorpusStats:
+        corpus_stat = os.stat(corpus_path)
+        return CorpusStats(
+            num_documents=self.num_documents,
+            total_length=self.total_length,
+            corpus_size=corpus_stat.st_size,
+            corpus_mtime=corpus_stat.st_mtime,
+        )
+
+
+def estimate_avg_length(
+        model: MiniCOIL,
+        converter: SparseVectorConverter,
+        documents: Iterable[Document],
+        batch_size: int = 256
+) -> float:
+    """
+    Average length of the given documents, in the units of `bm25_tf`.
+    Only tokenizer and vocab are used, no transformer, so it is cheap enough to run on a sample of the corpus
+    before the ingestion, when no stats are collected yet.
+    """
+    total_length = 0.0
+    num_documents = 0
+
+    batch = []
+    for document in documents:
+        batch.append(document.full_text)
+        if len(batch) >= batch_size:
+            total_length += _batch_length(model, converter, batch)
+            num_documents += len(batch)
+            batch = []
+
+    if batch:
+        total_length += _batch_length(model, converter, batch)
+        num_documents += len(batch)
+
+    return total_length / num_documents if num_documents > 0 else 0.0
+
+
+def _batch_length(model: MiniCOIL, converter: SparseVectorConverter, texts: list) -> float:
+    token_ids, attention_mask = model.sentence_encoder.tokenize_batch(texts)
+    _vocab_ids, counts, oov, _forms = model.vocab_resolver.resolve_tokens_batch(token_ids, attention_mask)
+
+    return sum(
+        converter.document_length(list(sentence_counts.values()), list(sentence_oov.keys()), list(sentence_oov.values()))
+        for sentence_counts, sentence_oov in zip(counts, oov)
+    )
+
+
+def test_corpus_stats_collector():
+    import tempfile
+
+    collector = CorpusStatsCollector()
+    collector.add(length=7)
+    collector.add(length=3)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_path = os.path.join(tmp_dir, "corpus.jsonl")
+        with open(corpus_path, "w") as f:
+            f.write("{}\n")
+
+        stats = collector.stats(corpus_path)
+        assert stats.num_documents == 2
+        assert stats.avg_len == 5.0
+
+        path = stats_path(corpus_path, "model")
+        stats.save(path)
+        loaded = CorpusStats.load(path, corpus_path)
+        assert loaded.avg_len == 5.0
+        assert loaded.num_documents == 2
+
+        with open(corpus_path, "a") as f:
+            f.write("{}\n")
+        assert CorpusStats.load(path, corpus_path) is None
@@ -1,82 +1,171 @@
 import argparse
 
 import os
-import json
-from typing import Dict, Iterable, Tuple
+from typing import Iterable, Optional, Tuple, Union
 
 from qdrant_client import QdrantClient, models
 
 import tqdm
 from minicoil_demo.config import DATA_DIR, QDRANT_API_KEY, QDRANT_URL
-from minicoil_demo.model.mini_coil import MiniCOIL, WordEmbedding
+from minicoil_demo.model.encoder import Encoder
+from minicoil_demo.model.mini_coil import MiniCOIL, SentenceEmbedding
 from minicoil_demo.model.sparse_vector import SparseVectorConverter
-from minicoil_demo.tools.common import calculate_avg_length
+from minicoil_demo.tools.checkpoint import Checkpoint, CheckpointTracker
+from minicoil_demo.tools.corpus import Corpus, Document, encode_documents
+from minicoil_demo.tools.corpus_stats import CorpusStats, CorpusStatsCollector, estimate_avg_length, stats_path
+from minicoil_demo.tools.encoding_cache import EncodingCache, EncodingCacheWriter, cache_embeddings, cached_embeddings, encoding_cache_path
+from minicoil_demo.tools.parallel_encoding import EncodedVector, EncodingConfig, parallel_sparse_vectors
+from minicoil_demo.tools.upload_pipeline import UploadPipeline
 
 DEFAULT_MODEL_NAME = os.getenv("MODEL_NAME", "minicoil.model")
 
+# Number of documents to estimate average length on, if corpus statistics are not collected yet
+AVG_LEN_SAMPLE_SIZE = 50_000
 
 
-def read_file(file_path, skip_first = 0) -> Iterable[Tuple[int, str]]:
-    if file_path.endswith(".json") or file_path.endswith(".jsonl"):
-        with open(file_path, "r") as f:
-            for idx, line in enumerate(f):
-                if idx < skip_first:
-                    continue
-                data = json.loads(line)
-                yield idx, data["_id"], data["title"], data["text"]
 
+def read_file(file_path, start_offset = 0, start_idx = 0, on_record = None) -> Iterable[Document]:
+    """
+    Read documents starting at `start_offset` bytes, `start_idx` is the line number of the document at that offset.
+    `on_record(idx, end_offset)` is called for every document with the offset right after it.
+    """
+    return Corpus(file_path).read(start_idx, start_offset=start_offset, on_record=on_record)
 
-def embedding_stream(model: MiniCOIL, file_path, skip_first = 0, parallel = None) -> Iterable[Dict[str, WordEmbedding]]:
-    stream = map(lambda x: x[2] + '\n' + x[3], read_file(file_path, skip_first=skip_first)) # https://github.com/castorini/anserini/blob/4de1d53629507eb9051300a38d46cbc460b4e7d9/src/main/java/io/anserini/collection/BeirFlatCollection.java#L77
-    for sentence_embeddings in model.encode_steam(stream, parallel=parallel):
+
+def encode_texts(model: MiniCOIL, texts: Iterable[str], batch_size = 4, parallel = None, max_batch_tokens = None) -> Iterable[SentenceEmbedding]:
+    if max_batch_tokens is not None:
+        # Batches of similar length, in-process only
+        yield from model.encode_steam_bucketed(texts, max_tokens=max_batch_tokens)
+        return
+
+    for sentence_embeddings in model.encode_steam(texts, batch_size=batch_size, parallel=parallel):
         yield sentence_embeddings
 
 
+def read_embeddings(
+        model: MiniCOIL,
+        file_path: str,
+        parallel: int = 4,
+        avg_len: float = 150.0,
+        batch_size: int = 4,
+        max_batch_tokens: int = None,
+        workers: int = 0,
+        start_offset: int = 0,
+        start_idx: int = 0,
+        on_record = None,
+        cache: Optional[EncodingCache] = None,
+        cache_writer: Optional[EncodingCacheWriter] = None
+) -> Iterable[Tuple[Document, Union[SentenceEmbedding, EncodedVector]]]:
+    """
+    Encoding stage of the ingestion: documents along with their embeddings,
+    or ready sparse vectors if the whole pipeline runs in worker processes.
+    The corpus is read once, the same documents provide payloads and texts to encode.
+
+    Embeddings are taken from `cache` if given, so the model is not run at all,
+    or added to `cache_writer` as they are computed.
+    """
+    documents = read_file(file_path, start_offset=start_offset, start_idx=start_idx, on_record=on_record)
+
+    if cache is not None:
+        return cached_embeddings(documents, cache)
+
+    if workers > 0:
+        # Whole pipeline runs in worker processes, vectors come back in the order of documents
+        config = EncodingConfig.from_model(model, avg_len=avg_len, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+        return encode_documents(documents, lambda texts: parallel_sparse_vectors(config, texts, workers=workers))
+
+    embeddings = encode_documents(
+        documents,
+        lambda texts: encode_texts(model, texts, batch_size=batch_size, parallel=parallel, max_batch_tokens=max_batch_tokens)
+    )
+
+    if cache_writer is not None:
+        embeddings = cache_embeddings(embeddings, cache_writer)
+
+    return embeddings
+
+
+def make_point(
+        model: MiniCOIL,
+        converter: SparseVectorConverter,
+        document: Document,
+        embedding: Union[SentenceEmbedding, EncodedVector],
+        stats: Optional[CorpusStatsCollector] = None
+) -> models.PointStruct:
+    """
+    Conversion stage of the ingestion, optionally collects corpus statistics on the way
+    """
+
+    if isinstance(embedding, EncodedVector):
+        # Converted in a worker process already
+        sparse_vector = embedding.vector
+        if stats is not None:
+            stats.add(embedding.length)
+    else:
+        indices, values = converter.sentence_embedding_to_arrays(model, embedding)
+        sparse_vector = models.SparseVector(indices=indices.tolist(), values=values.tolist())
+        if stats is not None:
+            stats.add(converter.document_length(embedding.counts, embedding.oov_words, embedding.oov_counts.tolist()))
+
+    return models.PointStruct(
+        id=document.idx,
+        vector={
+            "minicoil": sparse_vector,
+        },
+        payload={
+            "sentence": document.full_text,
+            "sentence_id": document.doc_id,
+        }
+    )
+
+
 def read_points(
         model: MiniCOIL,
         file_path: str,
         parallel: int = 4,
-        skip_first: int = 0,
-        avg_len: float = 150.0
+        avg_len: float = 150.0,
+        batch_size: int = 4,
+        max_batch_tokens: int = None,
+        workers: int = 0
 ) -> Iterable[models.PointStruct]:
     converted = SparseVectorConverter(avg_len=avg_len) #https://arxiv.org/pdf/2307.10488
-    sentences = read_file(file_path, skip_first=skip_first)
+    embeddings = read_embeddings(model, file_path, parallel=parallel, avg_len=avg_len, batch_size=batch_size, max_batch_tokens=max_batch_tokens, workers=workers)
 
-    embeddings = embedding_stream(model, file_path=file_path, skip_first=skip_first, parallel=parallel)
-    sparse_vectors = map(lambda x: converted.embedding_to_vector(model, x), embeddings)
-    
-    for (idx, sentence_id, title, text), sparse_vector in zip(sentences, sparse_vectors):
-        yield models.PointStruct(
-            id=idx,
-            vector={
-                "minicoil": sparse_vector,
-            },
-            payload={
-                "sentence": title + '\n' + text,
-                "sentence_id": sentence_id,
-            }
-        )
+    for document, embedding in embeddings:
+        yield make_point(model, converted, document, embedding)
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-name", type=str)
+    parser.add_argument("--word-encoder-path", type=str, default=None) # Overrides weights of the model, e.g. converted to float16 or int8
     parser.add_argument("--input-path", type=str) # Path to the corpus.jsonl of BEIR dataset
     parser.add_argument("--collection-name", type=str, default="minicoil-demo")
     parser.add_argument("--parallel", type=int, default=4)
-    parser.add_argument("--skip-first", type=int, default=0)
+    parser.add_argument("--checkpoint-path", type=str, default=None) # Defaults to <collection-name>.checkpoint.json in the data dir
+    parser.add_argument("--resume", action="store_true") # Continue from the checkpoint instead of re-creating the collection
+    parser.add_argument("--batch-size", type=int, default=4) # Number of documents encoded at once
+    parser.add_argument("--max-batch-tokens", type=int, default=None) # Group documents of similar length into batches of this many tokens, disables --parallel
+    parser.add_argument("--workers", type=int, default=0) # Run the whole document -> sparse vector pipeline in this many processes, overrides --parallel
+    parser.add_argument("--upload-batch-size", type=int, default=32) # Number of points in a single upsert request
+    parser.add_argument("--upload-in-flight", type=int, default=4) # Number of concurrent upsert requests
+    parser.add_argument("--encoder-mode", type=str, default=Encoder.MODE_GROUPED, choices=Encoder.MODES)
+    parser.add_argument("--mmap-weights", action="store_true") # Share word encoder weights between processes via page cache
+    parser.add_argument("--encodings-cache-dir", type=str, default=None) # Store document encodings on the first run, later runs only re-do the sparse vector conversion
     
     args = parser.parse_args()
 
     model_name = args.model_name or DEFAULT_MODEL_NAME
     vocab_path = os.path.join(DATA_DIR, f"{model_name}.vocab")
-    model_path = os.path.join(DATA_DIR, f"{model_name}.npy")
+    model_path = args.word_encoder_path or os.path.join(DATA_DIR, f"{model_name}.npy")
 
     transformer_model = "jinaai/jina-embeddings-v2-small-en-tokens"
 
     mini_coil = MiniCOIL(
         vocab_path=vocab_path,
         word_encoder_path=model_path,
-        sentence_encoder_model=transformer_model
+        sentence_encoder_model=transformer_model,
+        encoder_mode=args.encoder_mode,
+        mmap_weights=args.mmap_weights
     )
 
     qdrant_client = QdrantClient(
@@ -85,7 +174,19 @@ def main():
         prefer_grpc=True
     )
 
-    if args.skip_first == 0:
+    corpus_stats_path = stats_path(args.input_path, model_name)
+    corpus_stats = CorpusStats.load(corpus_stats_path, args.input_path)
+
+    checkpoint_path = args.checkpoint_path or os.path.join(DATA_DIR, f"{args.collection_name}.checkpoint.json")
+    checkpoint = Checkpoint.load(checkpoint_path) if args.resume else None
+
+    if checkpoint is not None:
+        checkpoint.validate(args.input_path, args.collection_name)
+        print(f"Resuming from document {checkpoint.next_idx} at byte offset {checkpoint.offset}")
+    else:
+        if args.resume:
+            print(f"No checkpoint found at {checkpoint_path}, starting from scratch")
+
         if qdrant_client.collection_exists(args.collection_name):
             print(f"Collection {args.collection_name} already exists. Deleting...")
             qdrant_client.delete_collection(args.collection_name)
@@ -103,19 +204,88 @@ def main():
             }
         )
 
-    print("Calculating average length of the dataset") #needed only for BEIR benchmarks, in our implementation of BM25/miniCOIL avg_len needs to be provided by the user
-    avg_len = calculate_avg_length(args.input_path)
-    print(f"Calculated average length: {avg_len}")
+        #needed only for BEIR benchmarks, in our implementation of BM25/miniCOIL avg_len needs to be provided by the user
+        if corpus_stats is not None:
+            avg_len = corpus_stats.avg_len
+            print(f"Using corpus statistics from {corpus_stats_path}: {corpus_stats.num_documents} documents, average length {avg_len:.2f}")
+        else:
+            # No stats before the first complete run, so the average length is estimated on a sample of the corpus
+            print(f"Estimating average length of the dataset on {AVG_LEN_SAMPLE_SIZE} documents")
+            avg_len = estimate_avg_length(mini_coil, SparseVectorConverter(), Corpus(args.input_path).read(stop=AVG_LEN_SAMPLE_SIZE))
+            print(f"Estimated average length: {avg_len:.2f}")
+
+        checkpoint = Checkpoint(corpus_path=args.input_path, collection_name=args.collection_name, avg_len=avg_len)
+        checkpoint.save(checkpoint_path)
+
+    # Same avg_len for all documents of the collection, even if the run is resumed
+    avg_len = checkpoint.avg_len
+    tracker = CheckpointTracker(checkpoint, checkpoint_path)
 
-    points_iterator = read_points(mini_coil, args.input_path, parallel=args.parallel, skip_first=args.skip_first, avg_len=avg_len)
+    # Exact statistics are collected during the first complete ingestion of the corpus and reused by later runs
+    stats_collector = None
+    if corpus_stats is None and checkpoint.next_idx == 0:
+        stats_collector = CorpusStatsCollector()
+
+    encodings_cache = None
+    cache_writer = None
+    if args.encodings_cache_dir is not None:
+        cache_path = encoding_cache_path(args.encodings_cache_dir, args.input_path, mini_coil)
+        encodings_cache = EncodingCache.open(cache_path, mini_coil.vocab_resolver, args.input_path)
+        if encodings_cache is not None:
+            print(f"Using document encodings from {cache_path}")
+        elif args.workers > 0:
+            # Workers return ready sparse vectors, encodings never leave the worker processes
+            print("Encodings cache is not written with --workers")
+        elif checkpoint.next_idx == 0:
+            # Rows of the cache are documents of the corpus, so it is written only by a complete run
+            cache_writer = EncodingCacheWriter(cache_path, mini_coil.output_dim)
+
+    embeddings = read_embeddings(
+        mini_coil,
+        args.input_path,
+        parallel=args.parallel,
+        avg_len=avg_len,
+        batch_size=args.batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        workers=args.workers,
+        start_offset=checkpoint.offset,
+        start_idx=checkpoint.next_idx,
+        on_record=tracker.on_record,
+        cache=encodings_cache,
+        cache_writer=cache_writer
+    )
+    converter = SparseVectorConverter(avg_len=avg_len) #https://arxiv.org/pdf/2307.10488
+
+    pipeline = UploadPipeline(
+        qdrant_client,
+        args.collection_name,
+        convert=lambda item: make_point(mini_coil, converter, *item, stats=stats_collector),
+        batch_size=args.upload_batch_size,
+        max_in_flight=args.upload_in_flight,
+        on_batch_uploaded=tracker.on_batch_uploaded
+    )
 
     import ipdb
     with ipdb.launch_ipdb_on_exception():
-        qdrant_client.upload_points(
-            collection_name=args.collection_name,
-            points=tqdm.tqdm(points_iterator),
-            batch_size=32
-        )
+        try:
+            stats = pipeline.run(tqdm.tqdm(embeddings))
+        except BaseException:
+            if cache_writer is not None:
+                cache_writer.abort()
+            raise
+        else:
+            # ipdb swallows the exception above, so everything, which needs the whole corpus to be ingested,
+            # is done here: a partial run must not leave an encodings cache or corpus statistics behind
+            print(f"Uploaded {stats.points} points in {stats.batches} batches, {stats.points_per_second:.1f} points/sec, {stats.retries} retries")
+
+            if cache_writer is not None:
+                cache_writer.commit(args.input_path)
+                print(f"Saved document encodings to {cache_writer.path}")
+
+            if stats_collector is not None:
+                corpus_stats = stats_collector.stats(args.input_path)
+                corpus_stats.save(corpus_stats_path)
+                print(f"Saved corpus statistics to {corpus_stats_path}: {corpus_stats.num_documents} documents, average length {corpus_stats.avg_len:.2f}")
 
 
 if __name__ == '__main__':
@@ -1,7 +1,6 @@
 import argparse
 
-import json
-from typing import Dict, Iterable, Tuple
+from typing import Iterable
 
 from qdrant_client import QdrantClient, models
 
@@ -9,21 +8,16 @@ import tqdm
 from minicoil_demo.config import DATA_DIR, QDRANT_API_KEY, QDRANT_URL
 from fastembed import SparseTextEmbedding, SparseEmbedding
 from minicoil_demo.tools.common import calculate_avg_length
+from minicoil_demo.tools.corpus import Corpus, Document, encode_documents
 
 
-def read_file(file_path, skip_first = 0) -> Iterable[Tuple[int, str]]:
-    if file_path.endswith(".json") or file_path.endswith(".jsonl"):
-        with open(file_path, "r") as f:
-            for idx, line in enumerate(f):
-                if idx < skip_first:
-                    continue
-                data = json.loads(line)
-                yield idx, data["_id"], data["title"], data["text"]
+def read_file(file_path, skip_first = 0) -> Iterable[Document]:
+    # Skipped documents are not read, the offsets index points to the first one to read
+    return Corpus(file_path).read(skip_first)
 
 
-def embedding_stream(model: SparseTextEmbedding, file_path, skip_first = 0, parallel = None) -> Iterable[Dict[str, SparseEmbedding]]:
-    stream = map(lambda x: x[2] + '\n' + x[3], read_file(file_path, skip_first=skip_first)) # https://github.com/castorini/anserini/blob/4de1d53629507eb9051300a38d46cbc460b4e7d9/src/main/java/io/anserini/collection/BeirFlatCollection.java#L77
-    for sentence_embeddings in model.embed(stream, parallel=parallel):
+def embedding_stream(model: SparseTextEmbedding, texts: Iterable[str], parallel = None) -> Iterable[SparseEmbedding]:
+    for sentence_embeddings in model.embed(texts, parallel=parallel):
         yield sentence_embeddings
 
 
@@ -34,11 +28,10 @@ def read_points(
         skip_first: int = 0,
         avg_len: float = 150.0
 ) -> Iterable[models.PointStruct]:
-    sentences = read_file(file_path, skip_first=skip_first)
+    documents = read_file(file_path, skip_first=skip_first)
+    embeddings = encode_documents(documents, lambda texts: embedding_stream(model, texts, parallel=parallel))
 
-    sparse_vectors = embedding_stream(model, file_path=file_path, skip_first=skip_first, parallel=parallel)
-    
-    for (idx, sentence_id, title, text), sparse_vector in zip(sentences, sparse_vectors):
+    for (idx, sentence_id, title, text), sparse_vector in embeddings:
         yield models.PointStruct(
             id=idx,
             vector={
@@ -0,0 +1,434 @@
+"""
+On-disk cache of document-side miniCOIL encodings.
+
+Re-indexing a corpus with different BM25 parameters, or into another collection, only needs
+`SparseVectorConverter`, so outputs of the transformer and the word encoder are stored once and reused.
+
+A cache is a directory, specific to the corpus and to the model (see `model_fingerprint`), with flat columnar files:
+
+    doc_ids.bin: utf-8 encoded document ids in the order of the corpus, concatenated
+    doc_id_offsets.npy: (num_documents + 1) int64 - byte ranges of ids in `doc_ids.bin`
+    word_offsets.npy: (num_documents + 1) int64 - known words of document `i` are [word_offsets[i], word_offsets[i + 1])
+    word_ids.npy: (num_words) int32
+    counts.npy: (num_words) int32
+    embeddings.npy: (num_words, output_dim) float32
+    oov_offsets.npy: (num_documents + 1) int64 - same for out-of-vocabulary words
+    oov_counts.npy: (num_oov_words) int32
+    oov_words.bin: utf-8 encoded out-of-vocabulary words, concatenated
+    oov_word_offsets.npy: (num_oov_words + 1) int64 - byte ranges of words in `oov_words.bin`
+    meta.json
+
+Out-of-vocabulary words, which the sparse vector conversion drops anyway (special tokens, punctuation
+and stopwords), are not stored.
+
+All files are memory-mapped on read, so opening a cache costs nothing, whatever the size of the corpus.
+The cache is written into a temporary directory, which is renamed
+once all documents are written, so an interrupted run never leaves a partial cache behind.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from minicoil_demo.model.encoder import scales_path
+from minicoil_demo.model.mini_coil import MiniCOIL, SentenceEmbedding
+from minicoil_demo.model.sparse_vector import SparseVectorConverter
+from minicoil_demo.model.vocab_resolver import VocabResolver
+from minicoil_demo.tools.corpus import Document
+
+# Bump on any change of the layout
+CACHE_FORMAT_VERSION = 2
+
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def _hash_file(hasher, path: str):
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+
+
+def digest_path(path: str) -> str:
+    return path + ".sha256"
+
+
+def file_digest(path: str) -> str:
+    """
+    sha256 of the file contents. Weights are hundreds of MB, so the digest is kept in a sidecar file
+    along with the size and mtime of the file, and the file is hashed again only once they change.
+    """
+    file_stat = os.stat(path)
+    stamp = {"size": file_stat.st_size, "mtime": file_stat.st_mtime}
+
+    sidecar_path = digest_path(path)
+    try:
+        with open(sidecar_path, "r") as f:
+            sidecar = json.load(f)
+        if sidecar.get("size") == stamp["size"] and sidecar.get("mtime") == stamp["mtime"]:
+            return sidecar["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    hasher = hashlib.sha256()
+    _hash_file(hasher, path)
+    digest = hasher.hexdigest()
+
+    try:
+        with open(sidecar_path, "w") as f:
+            json.dump({**stamp, "sha256": digest}, f)
+    except OSError:
+        # Read-only model directory, the file is hashed on every run then
+        pass
+    return digest
+
+
+def model_fingerprint(model: MiniCOIL) -> str:
+    """
+    Hash of everything, which affects document encodings: vocab, word encoder weights and the transformer
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"{CACHE_FORMAT_VERSION}:{model.sentence_encoder_model}:{model.input_dim}:{model.output_dim}".encode())
+    hasher.update(file_digest(model.vocab_path).encode())
+    hasher.update(file_digest(model.word_encoder_path).encode())
+    if os.path.exists(scales_path(model.word_encoder_path)):
+        hasher.update(file_digest(scales_path(model.word_encoder_path)).encode())
+    return hasher.hexdigest()
+
+
+def encoding_cache_path(cache_dir: str, corpus_path: str, model: MiniCOIL) -> str:
+    return os.path.join(cache_dir, f"{os.path.basename(corpus_path)}-{model_fingerprint(model)[:16]}")
+
+
+def _corpus_fingerprint(corpus_path: str) -> dict:
+    corpus_stat = os.stat(corpus_path)
+    return {"corpus_size": corpus_stat.st_size, "corpus_mtime": corpus_stat.st_mtime}
+
+
+class MappedStrings:
+    """
+    Strings, concatenated in a memory-mapped file, string `i` occupies bytes [offsets[i], offsets[i + 1])
+    """
+
+    def __init__(self, path: str, offsets: np.ndarray):
+        self.offsets = offsets
+        self.buffer = b""
+        if os.path.getsize(path) > 0:
+            # Empty file can't be mapped
+            with open(path, "rb") as f:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self.buffer[int(self.offsets[idx]):int(self.offsets[idx + 1])].decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def slice(self, start: int, end: int) -> List[str]:
+        offsets = self.offsets[start:end + 1].tolist()
+        return [
+            self.buffer[string_start:string_end].decode("utf-8")
+            for string_start, string_end in zip(offsets[:-1], offsets[1:])
+        ]
+
+
+class EncodingCacheWriter:
+
+    def __init__(self, path: str, output_dim: int, converter: Optional[SparseVectorConverter] = None):
+        """
+        Args:
+            path: directory of the cache
+            output_dim: size of word embeddings
+            converter: decides, which out-of-vocabulary words are worth storing, see `SparseVectorConverter.resolve_oov_word`
+        """
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.output_dim = output_dim
+        self.converter = converter if converter is not None else SparseVectorConverter()
+        self.aborted = False
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+        self.doc_ids_file = open(os.path.join(self.tmp_path, "doc_ids.bin"), "wb")
+        self.word_ids_file = open(os.path.join(self.tmp_path, "word_ids.bin"), "wb")
+        self.counts_file = open(os.path.join(self.tmp_path, "counts.bin"), "wb")
+        self.embeddings_file = open(os.path.join(self.tmp_path, "embeddings.bin"), "wb")
+        self.oov_counts_file = open(os.path.join(self.tmp_path, "oov_counts.bin"), "wb")
+        self.oov_words_file = open(os.path.join(self.tmp_path, "oov_words.bin"), "wb")
+
+        self.doc_id_offsets: List[int] = [0]
+        self.word_offsets: List[int] = [0]
+        self.oov_offsets: List[int] = [0]
+        self.oov_word_offsets: List[int] = [0]
+
+    def add(self, doc_id: str, embedding: SentenceEmbedding):
+        encoded_doc_id = doc_id.encode("utf-8")
+        self.doc_ids_file.write(encoded_doc_id)
+        self.doc_id_offsets.append(self.doc_id_offsets[-1] + len(encoded_doc_id))
+
+        self.word_ids_file.write(np.ascontiguousarray(embedding.word_ids, dtype=np.int32).tobytes())
+        self.counts_file.write(np.ascontiguousarray(embedding.counts, dtype=np.int32).tobytes())
+        self.embeddings_file.write(np.ascontiguousarray(embedding.embeddings, dtype=np.float32).tobytes())
+        self.word_offsets.append(self.word_offsets[-1] + len(embedding.word_ids))
+
+        # Most of raw OOV words are special tokens, punctuation and stopwords, which are never converted
+        oov_words = []
+        oov_counts = []
+        for word, count in zip(embedding.oov_words, embedding.oov_counts.tolist()):
+            if self.converter.resolve_oov_word(word):
+                oov_words.append(word)
+                oov_counts.append(count)
+
+        self.oov_counts_file.write(np.array(oov_counts, dtype=np.int32).tobytes())
+        self.oov_offsets.append(self.oov_offsets[-1] + len(oov_words))
+
+        byte_offset = self.oov_word_offsets[-1]
+        for word in oov_words:
+            encoded = word.encode("utf-8")
+            self.oov_words_file.write(encoded)
+            byte_offset += len(encoded)
+            self.oov_word_offsets.append(byte_offset)
+
+    def _close_files(self):
+        for f in (
+                self.doc_ids_file, self.word_ids_file, self.counts_file, self.embeddings_file,
+                self.oov_counts_file, self.oov_words_file
+        ):
+            f.close()
+
+    def _save_raw(self, name: str, dtype, shape: tuple):
+        """
+        Convert raw array file into `.npy`, by prepending the header in a new file
+        """
+        raw_path = os.path.join(self.tmp_path, f"{name}.bin")
+        array = np.lib.format.open_memmap(os.path.join(self.tmp_path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+        if array.size > 0:
+            array.reshape(-1)[:] = np.fromfile(raw_path, dtype=dtype)
+        array.flush()
+        del array
+        os.remove(raw_path)
+
+    def commit(self, corpus_path: str):
+        """
+        Finalize the cache, must be called only after all documents of the corpus are added
+        """
+        if self.aborted:
+            raise RuntimeError(f"Encoding cache {self.path} was aborted and can't be committed")
+
+        self._close_files()
+
+        num_words = self.word_offsets[-1]
+        num_oov_words = self.oov_offsets[-1]
+
+        self._save_raw("word_ids", np.int32, (num_words,))
+        self._save_raw("counts", np.int32, (num_words,))
+        self._save_raw("embeddings", np.float32, (num_words, self.output_dim))
+        self._save_raw("oov_counts", np.int32, (num_oov_words,))
+
+        np.save(os.path.join(self.tmp_path, "doc_id_offsets.npy"), np.array(self.doc_id_offsets, dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, "word_offsets.npy"), np.array(self.word_offsets, dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, "oov_offsets.npy"), np.array(self.oov_offsets, dtype=np.int64))
+        np.save(os.path.join(self.tmp_path, "oov_word_offsets.npy"), np.array(self.oov_word_offsets, dtype=np.int64))
+
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump({
+                "version": CACHE_FORMAT_VERSION,
+                "num_documents": len(self.word_offsets) - 1,
+                "output_dim": self.output_dim,
+                **_corpus_fingerprint(corpus_path),
+            }, f)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.aborted = True
+        self._close_files()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class EncodingCache:
+
+    def __init__(self, path: str, vocab_resolver: VocabResolver):
+        self.path = path
+        self.vocab_resolver = vocab_resolver
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.word_offsets = load("word_offsets")
+        self.word_ids = load("word_ids")
+        self.counts = load("counts")
+        self.embeddings = load("embeddings")
+        self.oov_offsets = load("oov_offsets")
+        self.oov_counts = load("oov_counts")
+
+        self.doc_ids = MappedStrings(os.path.join(path, "doc_ids.bin"), load("doc_id_offsets"))
+        self.oov_words = MappedStrings(os.path.join(path, "oov_words.bin"), load("oov_word_offsets"))
+
+    @classmethod
+    def open(cls, path: str, vocab_resolver: VocabResolver, corpus_path: str) -> Optional["EncodingCache"]:
+        """
+        Open the cache if it is complete and was built from the current version of the corpus
+        """
+        meta_path = os.path.join(path, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+
+        if meta.get("version") != CACHE_FORMAT_VERSION:
+            return None
+
+        fingerprint = _corpus_fingerprint(corpus_path)
+        if any(meta.get(key) != value for key, value in fingerprint.items()):
+            return None
+
+        return cls(path, vocab_resolver)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __getitem__(self, row: int) -> SentenceEmbedding:
+        word_start, word_end = int(self.word_offsets[row]), int(self.word_offsets[row + 1])
+        oov_start, oov_end = int(self.oov_offsets[row]), int(self.oov_offsets[row + 1])
+
+        return SentenceEmbedding(
+            word_ids=self.word_ids[word_start:word_end],
+            counts=self.counts[word_start:word_end],
+            embeddings=self.embeddings[word_start:word_end],
+            oov_words=self.oov_words.slice(oov_start, oov_end),
+            oov_counts=self.oov_counts[oov_start:oov_end],
+            # Forms are not used on the document side
+            forms={},
+            vocab_resolver=self.vocab_resolver,
+        )
+
+    def read(self, start: int = 0) -> Iterator[SentenceEmbedding]:
+        for row in range(start, len(self)):
+            yield self[row]
+
+
+def cached_embeddings(documents: Iterable[Document], cache: EncodingCache) -> Iterator[Tuple[Document, SentenceEmbedding]]:
+    """
+    Pair documents with their cached encodings, rows of the cache are in the order of the corpus
+    """
+    for document in documents:
+        if cache.doc_ids[document.idx] != document.doc_id:
+            raise ValueError(
+                f"Encoding cache {cache.path} doesn't match the corpus: "
+                f"expected document {cache.doc_ids[document.idx]} at line {document.idx}, got {document.doc_id}"
+            )
+        yield document, cache[document.idx]
+
+
+def cache_embeddings(
+        embeddings: Iterable[Tuple[Document, SentenceEmbedding]],
+        writer: EncodingCacheWriter
+) -> Iterator[Tuple[Document, SentenceEmbedding]]:
+    """
+    Pass encodings through, adding them to the cache on the way
+    """
+    for document, embedding in embeddings:
+        writer.add(document.doc_id, embedding)
+        yield document, embedding
+
+
+def test_encoding_cache():
+    import tempfile
+
+    embeddings = [
+        SentenceEmbedding(
+            word_ids=np.array([3, 7]),
+            counts=np.array([1, 2]),
+            embeddings=np.array([[0.1, 0.2], [0.3, 0.4]], dtype=np.float32),
+            oov_words=["[CLS]", "naïve", "the", ",", "[SEP]"],
+            oov_counts=np.array([1, 1, 2, 1, 1]),
+            forms={},
+            vocab_resolver=None,
+        ),
+        SentenceEmbedding(
+            word_ids=np.array([], dtype=np.int64),
+            counts=np.array([], dtype=np.int64),
+            embeddings=np.zeros((0, 2), dtype=np.float32),
+            oov_words=[],
+            oov_counts=np.array([], dtype=np.int64),
+            forms={},
+            vocab_resolver=None,
+        ),
+        SentenceEmbedding(
+            word_ids=np.array([1]),
+            counts=np.array([4]),
+            embeddings=np.array([[-0.5, 0.5]], dtype=np.float32),
+            oov_words=["café"],
+            oov_counts=np.array([3]),
+            forms={},
+            vocab_resolver=None,
+        ),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_path = os.path.join(tmp_dir, "corpus.jsonl")
+        with open(corpus_path, "w") as f:
+            f.write("{}\n")
+
+        path = os.path.join(tmp_dir, "cache")
+        writer = EncodingCacheWriter(path, output_dim=2)
+        for idx, embedding in enumerate(embeddings):
+            writer.add(f"doc{idx}", embedding)
+
+        assert EncodingCache.open(path, None, corpus_path) is None
+        writer.commit(corpus_path)
+
+        aborted = EncodingCacheWriter(path + "-aborted", output_dim=2)
+        aborted.abort()
+        try:
+            aborted.commit(corpus_path)
+            assert False, "exception is expected"
+        except RuntimeError:
+            pass
+        assert not os.path.exists(path + "-aborted")
+
+        cache = EncodingCache.open(path, None, corpus_path)
+        assert len(cache) == 3
+        assert list(cache.doc_ids) == ["doc0", "doc1", "doc2"]
+
+        for expected, actual in zip(embeddings, cache.read()):
+            assert actual.word_ids.tolist() == expected.word_ids.tolist()
+            assert actual.counts.tolist() == expected.counts.tolist()
+            assert np.array_equal(actual.embeddings, expected.embeddings)
+
+        # Only OOV words, which make it into sparse vectors, are stored
+        assert [embedding.oov_words for embedding in cache.read()] == [["naïve"], [], ["café"]]
+        assert [embedding.oov_counts.tolist() for embedding in cache.read()] == [[1], [], [3]]
+
+        documents = [Document(idx, f"doc{idx}", "", "") for idx in range(1, 3)]
+        assert [document.idx for document, _ in cached_embeddings(documents, cache)] == [1, 2]
+
+        with open(corpus_path, "a") as f:
+            f.write("{}\n")
+        assert EncodingCache.open(path, None, corpus_path) is None
+
+        weights_path = os.path.join(tmp_dir, "weights.npy")
+        with open(weights_path, "wb") as f:
+            f.write(b"weights")
+        digest = file_digest(weights_path)
+        assert os.path.exists(digest_path(weights_path))
+        assert file_digest(weights_path) == digest
+        with open(weights_path, "ab") as f:
+            f.write(b" changed")
+        assert file_digest(weights_path) != digest
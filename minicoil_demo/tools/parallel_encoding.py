@@ -0,0 +1,199 @@
+"""
+Multi-process ingestion: every worker runs the complete document -> sparse vector pipeline,
+i.e. transformer, vocab resolution, word encoder and sparse vector conversion.
+
+Workers return vectors of a chunk as flat arrays in a shared memory segment:
+
+    offsets: (num_vectors + 1) int64 - vector `i` occupies [offsets[i], offsets[i + 1])
+    lengths: (num_vectors) float64 - lengths of documents, see `SparseVectorConverter.document_length`
+    indices: (num_values) uint32
+    values: (num_values) float32
+
+so only the name of the segment is pickled. Chunks are reassembled in submission order,
+so the output order, and therefore point ids, do not depend on the number of workers.
+"""
+import multiprocessing
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from fastembed.common.utils import iter_batch
+from qdrant_client import models
+
+from minicoil_demo.model.encoder import Encoder
+from minicoil_demo.model.mini_coil import MiniCOIL
+from minicoil_demo.model.sparse_vector import SparseVectorConverter
+
+
+@dataclass
+class EncodingConfig:
+    vocab_path: str
+    word_encoder_path: str
+    sentence_encoder_model: str = "jinaai/jina-embeddings-v2-small-en-tokens"
+    encoder_mode: str = Encoder.MODE_GROUPED
+    mmap_weights: bool = True
+    avg_len: float = 150.0
+    batch_size: int = 4
+    max_batch_tokens: Optional[int] = None
+
+    @classmethod
+    def from_model(cls, model: MiniCOIL, **kwargs) -> "EncodingConfig":
+        return cls(
+            vocab_path=model.vocab_path,
+            word_encoder_path=model.word_encoder_path,
+            sentence_encoder_model=model.sentence_encoder_model,
+            encoder_mode=model.encoder_mode,
+            mmap_weights=model.mmap_weights,
+            **kwargs
+        )
+
+
+@dataclass
+class EncodedVector:
+    vector: models.SparseVector
+    # Length of the document, collected into corpus statistics
+    length: float
+
+
+@dataclass
+class SharedVectors:
+    name: str
+    num_vectors: int
+    num_values: int
+
+
+def _shared_views(buffer, num_vectors: int, num_values: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    offsets = np.ndarray((num_vectors + 1,), dtype=np.int64, buffer=buffer)
+    lengths = np.ndarray((num_vectors,), dtype=np.float64, buffer=buffer, offset=offsets.nbytes)
+    indices_offset = offsets.nbytes + lengths.nbytes
+    indices = np.ndarray((num_values,), dtype=np.uint32, buffer=buffer, offset=indices_offset)
+    values = np.ndarray((num_values,), dtype=np.float32, buffer=buffer, offset=indices_offset + indices.nbytes)
+    return offsets, lengths, indices, values
+
+
+def write_shared_vectors(vectors: List[Tuple[np.ndarray, np.ndarray]], document_lengths: List[float]) -> SharedVectors:
+    sizes = np.fromiter((len(indices) for indices, _ in vectors), dtype=np.int64, count=len(vectors))
+    num_values = int(sizes.sum())
+
+    # Indices are below 2^31, see `SparseVectorConverter.remap_hash`, values are stored as float32 by Qdrant anyway
+    shm = SharedMemory(create=True, size=(len(vectors) + 1) * 8 + len(vectors) * 8 + num_values * 8)
+    offsets, lengths, indices, values = _shared_views(shm.buf, len(vectors), num_values)
+
+    offsets[0] = 0
+    np.cumsum(sizes, out=offsets[1:])
+    lengths[:] = document_lengths
+    if num_values > 0:
+        np.concatenate([vector_indices for vector_indices, _ in vectors], out=indices, casting="unsafe")
+        np.concatenate([vector_values for _, vector_values in vectors], out=values, casting="unsafe")
+
+    # Views must be released before the segment is closed
+    del offsets, lengths, indices, values
+    shm.close()
+
+    return SharedVectors(name=shm.name, num_vectors=len(vectors), num_values=num_values)
+
+
+def read_shared_vectors(shared: SharedVectors) -> List[EncodedVector]:
+    """
+    Read vectors and release the shared memory segment
+    """
+    shm = SharedMemory(name=shared.name)
+    try:
+        offsets, lengths, indices, values = _shared_views(shm.buf, shared.num_vectors, shared.num_values)
+        bounds = offsets.tolist()
+        vectors = [
+            EncodedVector(
+                vector=models.SparseVector(indices=indices[start:end].tolist(), values=values[start:end].tolist()),
+                length=length
+            )
+            for start, end, length in zip(bounds[:-1], bounds[1:], lengths.tolist())
+        ]
+        del offsets, lengths, indices, values
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return vectors
+
+
+def release_shared_vectors(shared: SharedVectors):
+    shm = SharedMemory(name=shared.name)
+    shm.close()
+    shm.unlink()
+
+
+# Model and converter of the current worker process, see `init_worker`
+_worker_state: Optional[Tuple[MiniCOIL, SparseVectorConverter, EncodingConfig]] = None
+
+
+def init_worker(config: EncodingConfig):
+    global _worker_state
+
+    model = MiniCOIL(
+        vocab_path=config.vocab_path,
+        word_encoder_path=config.word_encoder_path,
+        sentence_encoder_model=config.sentence_encoder_model,
+        encoder_mode=config.encoder_mode,
+        mmap_weights=config.mmap_weights
+    )
+    converter = SparseVectorConverter(avg_len=config.avg_len)
+    _worker_state = (model, converter, config)
+
+
+def encode_chunk(texts: List[str]) -> SharedVectors:
+    model, converter, config = _worker_state
+
+    if config.max_batch_tokens is not None:
+        embeddings = model.encode_steam_bucketed(texts, max_tokens=config.max_batch_tokens)
+    else:
+        embeddings = model.encode_steam(texts, batch_size=config.batch_size)
+
+    vectors = []
+    lengths = []
+    for embedding in embeddings:
+        vectors.append(converter.sentence_embedding_to_arrays(model, embedding))
+        lengths.append(converter.document_length(embedding.counts, embedding.oov_words, embedding.oov_counts.tolist()))
+
+    return write_shared_vectors(vectors, lengths)
+
+
+def parallel_sparse_vectors(
+        config: EncodingConfig,
+        texts: Iterable[str],
+        workers: int,
+        chunk_size: int = 256,
+        max_pending: Optional[int] = None
+) -> Iterable[EncodedVector]:
+    """
+    Encode texts into sparse vectors in `workers` processes, vectors are yielded in the order of texts.
+
+    Args:
+        config: model and conversion parameters, each worker loads its own model
+        texts: stream of documents, consumed lazily
+        workers: number of worker processes
+        chunk_size: number of documents sent to a worker at once
+        max_pending: limit of chunks in flight, which bounds memory usage. Default is 2 chunks per worker
+    """
+    max_pending = max_pending or 2 * workers
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    context = multiprocessing.get_context(start_method)
+
+    with context.Pool(workers, initializer=init_worker, initargs=(config,)) as pool:
+        pending = deque()
+        try:
+            for chunk in iter_batch(texts, chunk_size):
+                pending.append(pool.apply_async(encode_chunk, (chunk,)))
+                if len(pending) >= max_pending:
+                    yield from read_shared_vectors(pending.popleft().get())
+
+            while pending:
+                yield from read_shared_vectors(pending.popleft().get())
+        finally:
+            # Consumer stopped early or a worker failed, segments of finished chunks are still to be released
+            while pending:
+                try:
+                    release_shared_vectors(pending.popleft().get())
+                except Exception:
+                    pass
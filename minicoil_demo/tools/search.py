@@ -36,7 +36,7 @@ def main():
     
     embeddings = mini_coil.encode([args.query])[0]
 
-    print(f"Embeddings: {embeddings}")
+    print(f"Embeddings: {embeddings.word_embeddings}")
     
     sparse_vector = converter.embedding_to_vector_query(mini_coil, embeddings)
     
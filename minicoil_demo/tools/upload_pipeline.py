@@ -0,0 +1,249 @@
+"""
+Pipelined upload into Qdrant, so that encoding and network I/O overlap.
+
+Three stages run in their own threads and are connected by bounded queues, so a slow stage blocks
+the previous one instead of accumulating unbounded amounts of data:
+
+    encoder:   pulls items from the (lazy, encoding) input iterator
+    converter: converts items into points and groups them into batches
+    uploaders: `max_in_flight` threads, each sending one batch at a time
+
+Encoding (ONNX, numpy) and network calls release the GIL, so threads are enough to keep CPU busy during uploads.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional
+
+from qdrant_client import QdrantClient, models
+
+# Marks the end of a stream in a queue
+_DONE = object()
+
+
+@dataclass
+class UploadStats:
+    points: int = 0
+    batches: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def points_per_second(self) -> float:
+        return self.points / self.elapsed if self.elapsed > 0 else 0.0
+
+
+@dataclass
+class UploadBatch:
+    # Sequential number of the batch, in the order of input items
+    seq: int
+    points: List[models.PointStruct]
+
+
+class UploadPipeline:
+
+    def __init__(
+            self,
+            client: QdrantClient,
+            collection_name: str,
+            convert: Callable[[Any], models.PointStruct],
+            batch_size: int = 32,
+            max_in_flight: int = 4,
+            queue_size: int = 256,
+            max_retries: int = 3,
+            on_batch_uploaded: Optional[Callable[[UploadBatch], None]] = None
+    ):
+        """
+        Args:
+            client: Qdrant client, shared between uploader threads
+            collection_name: collection to upload points into
+            convert: converts an input item into a point
+            batch_size: number of points in a single upsert request
+            max_in_flight: number of concurrent upsert requests
+            queue_size: number of items buffered between the encoder and the converter
+            max_retries: attempts to re-send a failed batch before giving up
+            on_batch_uploaded: called after a batch is acknowledged by Qdrant.
+                Batches might be acknowledged out of order, use `UploadBatch.seq` to restore it.
+        """
+        self.client = client
+        self.collection_name = collection_name
+        self.convert = convert
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.on_batch_uploaded = on_batch_uploaded
+
+        self.items = queue.Queue(maxsize=queue_size)
+        self.batches = queue.Queue(maxsize=max_in_flight)
+
+        self.stop = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.stats = UploadStats()
+        self.lock = threading.Lock()
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        """
+        Put with backpressure, returns False if the pipeline is stopped
+        """
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, error: BaseException):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stop.set()
+
+    def _encode(self, items: Iterable[Any]):
+        try:
+            for item in items:
+                if not self._put(self.items, item):
+                    return
+            self._put(self.items, _DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def _convert(self):
+        try:
+            seq = 0
+            points = []
+            while True:
+                item = self._get(self.items)
+                if item is _DONE:
+                    break
+                points.append(self.convert(item))
+                if len(points) >= self.batch_size:
+                    if not self._put(self.batches, UploadBatch(seq=seq, points=points)):
+                        return
+                    seq += 1
+                    points = []
+
+            if self.stop.is_set():
+                return
+
+            if points:
+                self._put(self.batches, UploadBatch(seq=seq, points=points))
+
+            for _ in range(self.max_in_flight):
+                self._put(self.batches, _DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def _upload_batch(self, batch: UploadBatch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.client.upsert(collection_name=self.collection_name, points=batch.points, wait=True)
+                return
+            except Exception:
+                if attempt == self.max_retries or self.stop.is_set():
+                    raise
+                with self.lock:
+                    self.stats.retries += 1
+                time.sleep(2 ** attempt)
+
+    def _upload(self):
+        try:
+            while True:
+                batch = self._get(self.batches)
+                if batch is _DONE:
+                    return
+
+                self._upload_batch(batch)
+
+                with self.lock:
+                    self.stats.points += len(batch.points)
+                    self.stats.batches += 1
+                    if self.on_batch_uploaded is not None:
+                        self.on_batch_uploaded(batch)
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self, items: Iterable[Any]) -> UploadStats:
+        """
+        Upload all items, blocks until every batch is acknowledged.
+        The first error of any stage stops the pipeline and is re-raised.
+        """
+        start = time.perf_counter()
+
+        threads = [
+            threading.Thread(target=self._encode, args=(items,), name="encoder", daemon=True),
+            threading.Thread(target=self._convert, name="converter", daemon=True),
+        ] + [
+            threading.Thread(target=self._upload, name=f"uploader-{i}", daemon=True)
+            for i in range(self.max_in_flight)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                # Join with timeout, so that KeyboardInterrupt is delivered to the main thread
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except BaseException:
+            self.stop.set()
+            raise
+
+        self.stats.elapsed = time.perf_counter() - start
+
+        if self.error is not None:
+            raise self.error
+
+        return self.stats
+
+
+def test_upload_pipeline():
+    client = QdrantClient(":memory:")
+    client.create_collection(
+        collection_name="test",
+        vectors_config={},
+        sparse_vectors_config={"minicoil": models.SparseVectorParams()}
+    )
+
+    uploaded = []
+    pipeline = UploadPipeline(
+        client,
+        "test",
+        convert=lambda idx: models.PointStruct(
+            id=idx,
+            vector={"minicoil": models.SparseVector(indices=[idx], values=[1.0])},
+            payload={"idx": idx}
+        ),
+        batch_size=7,
+        max_in_flight=3,
+        queue_size=5,
+        on_batch_uploaded=lambda batch: uploaded.append(batch.seq)
+    )
+
+    stats = pipeline.run(range(100))
+
+    assert stats.points == 100
+    assert stats.batches == 15
+    assert sorted(uploaded) == list(range(15))
+    assert client.count("test").count == 100
+
+    def failing_items():
+        yield from range(10)
+        raise ValueError("encoding failed")
+
+    pipeline = UploadPipeline(client, "test", convert=lambda idx: models.PointStruct(id=idx, vector={}))
+    try:
+        pipeline.run(failing_items())
+        assert False, "error is expected"
+    except ValueError:
+        pass